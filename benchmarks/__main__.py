@@ -0,0 +1,157 @@
+#  -*- coding: utf-8 -*-
+"""
+Benchmark harness running cipa against generated directories
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+import dns.resolver
+from prettytable import PrettyTable
+
+from checkipaconsistency.checks import CHECKS as REGISTRY
+from checkipaconsistency.main import Main
+from .standin import Directory, Stats, install
+
+CHECKS = list(REGISTRY)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark cipa against generated in-process directories')
+    parser.add_argument('--servers', type=int, default=3, help='number of IPA servers (default: 3)')
+    parser.add_argument('--users', type=int, default=10000, help='users per server (default: 10000)')
+    parser.add_argument('--hosts', type=int, default=10000,
+                        help='hosts and services per server (default: 10000)')
+    parser.add_argument('--certs', type=int, default=10000, help='certificates per server (default: 10000)')
+    parser.add_argument('--conflicts', type=int, default=0, help='LDAP conflicts per server (default: 0)')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.001],
+                        help='seconds added to every round trip, one value per server or one for all (default: 0.001)')
+    parser.add_argument('--threads', type=int, default=10, help='number of servers probed in parallel (default: 10)')
+    parser.add_argument('--page-size', type=int, default=1000, help='entries per page (default: 1000)')
+    parser.add_argument('--deadline', type=float, help='seconds the checks have to finish in (default: none)')
+    parser.add_argument('--checks', nargs='*', choices=CHECKS, default=CHECKS,
+                        help='checks to also run on their own (default: all)')
+    parser.add_argument('--json', dest='json_file', help='also write the results to a JSON file')
+    return parser.parse_args()
+
+
+def _maxrss():
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _fail_dns(*args, **kwargs):
+    raise dns.resolver.NXDOMAIN()
+
+
+def _run(args, check, queue):
+    # runs in a child process of its own, so that its peak memory is not hidden by earlier runs
+    domain = 'ipa.example.com'
+    hosts = ['ipa%02d.%s' % (i + 1, domain) for i in range(args.servers)]
+    directories = dict((host, Directory(host, domain, hosts, users=args.users, hosts=args.hosts, certs=args.certs,
+                                        conflicts=args.conflicts)) for host in hosts)
+    latencies = dict((host, args.latency[i % len(args.latency)]) for i, host in enumerate(hosts))
+    stats = Stats()
+    install(directories, latencies, stats)
+    dns.resolver.query = _fail_dns
+
+    sys.argv = ['cipa', '-d', domain, '-W', 'benchmark', '-H'] + hosts + [
+        '-t', str(args.threads), '-p', str(args.page_size), '--quiet', '--no-cache']
+    if args.deadline is not None:
+        sys.argv += ['--deadline', str(args.deadline)]
+    if check:
+        sys.argv += ['-n', check]
+
+    baseline = _maxrss()
+    start = time.time()
+    try:
+        Main().run()
+    except SystemExit:
+        pass
+    except Exception:
+        queue.put({'run': check or 'all', 'error': traceback.format_exc()})
+        return
+    wall = time.time() - start
+
+    queue.put({
+        'run': check or 'all',
+        'wall': wall,
+        'searches': stats.searches,
+        'entries': stats.entries,
+        'throughput': stats.entries / wall if wall else 0,
+        'memory': (_maxrss() - baseline) / 1024.0,
+    })
+
+
+def main():
+    args = parse_args()
+    # the runs inherit the parsed arguments and imported modules
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+    # keep the config file and caches cipa creates away from the user's
+    workdir = tempfile.mkdtemp(prefix='cipa-bench-')
+    os.environ['XDG_CONFIG_HOME'] = os.environ['XDG_CACHE_HOME'] = workdir
+
+    results = []
+    for check in [None] + args.checks:
+        queue = context.Queue()
+        process = context.Process(target=_run, args=(args, check, queue))
+        process.start()
+        process.join()
+        if queue.empty():
+            print('Run %s died with exit code %s' % (check or 'all', process.exitcode), file=sys.stderr)
+            exit(1)
+        result = queue.get()
+        if 'error' in result:
+            print('Run %s failed:\n%s' % (result['run'], result['error']), file=sys.stderr)
+            exit(1)
+        results.append(result)
+
+    table = PrettyTable(['Run', 'Wall (s)', 'Searches', 'Entries', 'Entries/s', 'Peak memory (MiB)'])
+    table.align = 'r'
+    table.align['Run'] = 'l'
+    for result in results:
+        table.add_row([result['run'], '%.3f' % result['wall'], result['searches'], result['entries'],
+                       '%.0f' % result['throughput'], '%.1f' % result['memory']])
+    print('%s servers, %s users, %s hosts, %s certificates, %s conflicts, latency %s s%s' %
+          (args.servers, args.users, args.hosts, args.certs, args.conflicts,
+           ' '.join(str(latency) for latency in args.latency),
+           '' if args.deadline is None else ', deadline %s s' % args.deadline))
+    print(table)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as json_file:
+            json.dump({'parameters': vars(args), 'results': results}, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
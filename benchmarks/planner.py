@@ -0,0 +1,91 @@
+#  -*- coding: utf-8 -*-
+"""
+Regression check of the search planner against a generated directory
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import sys
+
+import ldap
+from prettytable import PrettyTable
+
+from checkipaconsistency.checks import normalize_dn, plan
+from .standin import Directory
+
+DOMAIN = 'ipa.example.com'
+BASE_DN = 'dc=ipa,dc=example,dc=com'
+ATTRS = ['numSubordinates']
+
+
+def _read(dn, attrs=ATTRS):
+    return dn, '(objectClass=*)', attrs, ldap.SCOPE_BASE
+
+
+# a batch mixing reads of the same entry, of siblings, of entries nested below others, of entries right below the
+# root and a search that is not a read, along with the number of searches it has to be planned into: one per group
+# of siblings, one per top-level entry and the search itself
+BATCH = [
+    ('users', _read('cn=users,cn=accounts,' + BASE_DN)),
+    ('users again', _read('cn=users,cn=accounts,' + BASE_DN)),
+    ('host groups', _read('cn=hostgroups,cn=accounts,' + BASE_DN)),
+    ('staged users', _read('cn=staged users,cn=accounts,cn=provisioning,' + BASE_DN)),
+    ('preserved users', _read('cn=deleted users,cn=accounts,cn=provisioning,' + BASE_DN)),
+    ('user1', _read('uid=user1,cn=users,cn=accounts,' + BASE_DN)),
+    ('user2', _read('uid=user2,cn=users,cn=accounts,' + BASE_DN)),
+    ('config', _read('cn=config', ['nsslapd-localhost'])),
+    ('monitor', _read('cn=monitor', ['nsslapd-localhost'])),
+    ('hosts', ('cn=computers,cn=accounts,' + BASE_DN, '(fqdn=*)', ['1.1'], ldap.SCOPE_SUBTREE)),
+]
+SEARCHES = 6
+
+
+def main():
+    directory = Directory('ipa01.' + DOMAIN, DOMAIN, ['ipa01.' + DOMAIN], users=10, hosts=10, certs=10)
+    operations = plan(BATCH)
+
+    table = PrettyTable(['Base', 'Scope', 'Filter', 'Entries', 'Answers'])
+    table.align = 'l'
+    failed = []
+    for (base, fltr, attrs, scope), answers in operations:
+        try:
+            found = set(normalize_dn(dn) for dn, entry in directory.search(base, scope, fltr))
+        except ldap.LDAPError:
+            found = set()
+        for name, dn in answers:
+            # searches other than reads only have to find something
+            if dn not in found and not (dn is None and found):
+                failed.append(name)
+        table.add_row([base, scope, fltr, len(found), ', '.join(name for name, dn in answers)])
+    print('%s queries planned into %s searches (expected %s)' % (len(BATCH), len(operations), SEARCHES))
+    print(table)
+
+    if failed:
+        print('Not answered by their searches: %s' % ', '.join(failed), file=sys.stderr)
+    if len(operations) != SEARCHES:
+        print('Planner regressed: %s searches instead of %s' % (len(operations), SEARCHES), file=sys.stderr)
+    if failed or len(operations) != SEARCHES:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
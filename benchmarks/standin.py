@@ -0,0 +1,303 @@
+#  -*- coding: utf-8 -*-
+"""
+Benchmark LDAP stand-in module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import itertools
+import re
+import threading
+import time
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+TIMESTAMP = '20180101000000Z'
+
+# time of the last change made on every replica, as in a CSN
+CHANGED = 0x5a497a00
+
+_MARK = re.compile(r'\((entryUSN|modifyTimestamp)>=([^)]+)\)', re.I)
+_RDN = re.compile(r'\(cn=([^)*]+)\)', re.I)
+_EQUALITY = re.compile(r'\(([\w-]+)=([^)*]+)\)')
+_SERIALS = re.compile(r'\(serialno>=(\d+)\)\(serialno<=(\d+)\)', re.I)
+
+
+# container of generated entries, the entries are only built while they are being returned so a directory of a
+# million users costs no memory until it is searched
+class Container(object):
+    def __init__(self, dn, count, rdn, attrs):
+        self.dn = dn
+        self.count = count
+        self._rdn = rdn
+        self._attrs = attrs
+
+    @staticmethod
+    def _format(value, i):
+        return value % i if '%' in value else value
+
+    def entry(self, i):
+        attrs = dict((name, [self._format(value, i).encode('utf-8') for value in values])
+                     for name, values in self._attrs.items())
+        attrs['modifyTimestamp'] = [TIMESTAMP.encode('utf-8')]
+        attrs['entryUSN'] = [str(i).encode('utf-8')]
+        return '%s,%s' % (self._format(self._rdn, i), self.dn), attrs
+
+    def entries(self, start=0):
+        return (self.entry(i) for i in range(start, self.count))
+
+    def find(self, fltr):
+        # entries selected by their RDNs in the filter, None if it does not select any by RDN
+        attr, _, rdn = self._rdn.partition('=')
+        values = [v for a, v in _EQUALITY.findall(fltr) if a.lower() == attr.lower()]
+        if not values:
+            return None
+        pattern = re.compile(re.escape(rdn).replace(re.escape('%d'), r'(\d+)') + '$', re.I)
+        matches = [pattern.match(value) for value in values]
+        return iter([self.entry(int(m.group(1))) for m in matches if m and int(m.group(1)) < self.count])
+
+
+# generated FreeIPA directory of a single server
+class Directory(object):
+    def __init__(self, host, domain, servers, users=10000, hosts=10000, certs=10000, conflicts=0, lag=0,
+                 busy=0):
+        self.host = host
+        base_dn = 'dc=' + domain.replace('.', ',dc=')
+        realm = domain.upper()
+        suffix = base_dn.replace('=', '\\3D').replace(',', '\\2C')
+        self.config = {
+            'nsslapd-localhost': [host.encode('utf-8')],
+            'nsslapd-defaultnamingcontext': [base_dn.encode('utf-8')],
+            'nsslapd-allow-anonymous-access': [b'rootdse'],
+        }
+        self.base_dn = base_dn
+        # busy operations are in progress besides the one reading cn=monitor
+        self.monitor = {
+            'threads': [b'16'],
+            'opsInitiated': [str(1001 + busy).encode('utf-8')],
+            'opsCompleted': [b'1000'],
+            'currentConnections': [str(10 + busy).encode('utf-8')],
+        }
+        self.agreements = 'cn=replica,cn=%s,cn=mapping tree,cn=config' % suffix
+        # the servers replicate in a ring, each has agreements with its neighbours
+        ring = list(zip(servers, servers[1:] + servers[:1]))[:len(servers) if len(servers) > 2 else 1]
+        self.topology = 'cn=domain,cn=topology,cn=ipa,cn=etc,' + base_dn
+        self.segments = [('cn=%s-to-%s,%s' % (left, right, self.topology), {
+            'ipaReplTopoSegmentLeftNode': [left.encode('utf-8')],
+            'ipaReplTopoSegmentRightNode': [right.encode('utf-8')],
+            'ipaReplTopoSegmentDirection': [b'both'],
+        }) for left, right in ring if left != right]
+        self.servers = sorted(set([right for left, right in ring if left == host] +
+                                  [left for left, right in ring if right == host]) - set([host]))
+        # replica update vector, the changes of the other replicas arrive lag seconds late
+        self.ruv = [b'{replicageneration} 5a497a00000000030000'] + [
+            ('{replica %d ldap://%s:389} %08x000000%02x0000 %08x000000%02x0000' % (
+                rid, server, CHANGED - 3600, rid, CHANGED - (lag if server != host else 0), rid)).encode('utf-8')
+            for rid, server in enumerate(servers, 3)]
+
+        containers = [
+            Container('cn=users,cn=accounts,' + base_dn, users, 'uid=user%d',
+                      {'uid': ['user%d'], 'objectClass': ['person', 'posixaccount']}),
+            Container('cn=staged users,cn=accounts,cn=provisioning,' + base_dn, 0, 'uid=staged%d', {}),
+            Container('cn=deleted users,cn=accounts,cn=provisioning,' + base_dn, 0, 'uid=deleted%d', {}),
+            Container('cn=computers,cn=accounts,' + base_dn, hosts, 'fqdn=host%%d.%s' % domain,
+                      {'fqdn': ['host%%d.%s' % domain]}),
+            Container('cn=services,cn=accounts,' + base_dn, hosts,
+                      'krbprincipalname=HTTP/host%%d.%s@%s' % (domain, realm),
+                      {'krbprincipalname': ['HTTP/host%%d.%s@%s' % (domain, realm)]}),
+            Container('cn=groups,cn=accounts,' + base_dn, max(users // 100, 1), 'cn=group%d',
+                      {'cn': ['group%d'], 'objectClass': ['ipausergroup']}),
+            Container('cn=hostgroups,cn=accounts,' + base_dn, max(hosts // 100, 1), 'cn=hostgroup%d', {}),
+            Container('cn=ng,cn=alt,' + base_dn, 10, 'ipaUniqueID=ng%d', {'ipaUniqueID': ['ng%d']}),
+            Container('cn=hbac,' + base_dn, 10, 'ipaUniqueID=hbac%d', {'ipaUniqueID': ['hbac%d']}),
+            Container('cn=sudorules,cn=sudo,' + base_dn, 10, 'ipaUniqueID=sudo%d', {'ipaUniqueID': ['sudo%d']}),
+            Container('cn=dns,' + base_dn, 10, 'idnsname=zone%%d.%s.' % domain,
+                      {'objectClass': ['idnszone'], 'idnsname': ['zone%%d.%s.' % domain]}),
+            Container('ou=certificateRepository,ou=ca,o=ipaca', certs, 'cn=%d',
+                      {'serialno': ['%d'], 'certStatus': ['VALID'], 'subjectName': ['CN=host%%d.%s' % domain],
+                       'notBefore': ['20250101000000Z'], 'notAfter': ['20270101000000Z']}),
+        ]
+        self.containers = dict((container.dn.lower(), container) for container in containers)
+        self.conflicts = Container('cn=users,cn=accounts,' + base_dn, conflicts,
+                                   'uid=user%d+nsuniqueid=00000000-00000000-00000000-00000000',
+                                   {'nsds5ReplConflict': ['namingConflict (ADD) uid=user%d']})
+
+    def _agreement(self, server):
+        return 'cn=meTo%s,%s' % (server, self.agreements), {
+            'nsDS5ReplicaHost': [server.encode('utf-8')],
+            'nsds5replicaLastUpdateStatus': [b'Error (0) Replica acquired successfully: Incremental update succeeded'],
+        }
+
+    def _root_dse(self):
+        last = {}
+        for dn, container in self.containers.items():
+            backend = 'ipaca' if dn.endswith('o=ipaca') else 'userroot'
+            last[backend] = max(last.get(backend, -1), container.count - 1)
+        return dict(('lastusn;%s' % backend, [str(usn).encode('utf-8')]) for backend, usn in last.items())
+
+    @staticmethod
+    def _read(container):
+        return container.dn, {'numSubordinates': [str(container.count).encode('utf-8')]}
+
+    def search(self, base, scope, fltr):
+        # returns an iterator of the entries the search matches, enough of a directory for what cipa asks
+        lower = base.lower()
+        if scope == ldap.SCOPE_BASE:
+            if lower == '':
+                # root DSE, the USNs of every container are counted from 0
+                return iter([(base, self._root_dse())])
+            if lower == 'cn=config':
+                return iter([(base, self.config)])
+            if lower == 'cn=monitor':
+                return iter([(base, self.monitor)])
+            if lower == 'nsuniqueid=ffffffff-ffffffff-ffffffff-ffffffff,' + self.base_dn:
+                return iter([(base, {'nsds50ruv': self.ruv})])
+            if lower in self.containers:
+                return iter([self._read(self.containers[lower])])
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+
+        if 'nstombstone' in fltr.lower():
+            return iter([])
+        if 'nsds5replconflict' in fltr.lower():
+            return self.conflicts.entries() if lower == self.base_dn else iter([])
+        if lower == self.agreements.lower():
+            return iter([self._agreement(server) for server in self.servers])
+        if lower == self.topology.lower():
+            return iter(self.segments)
+        if lower not in self.containers and scope == ldap.SCOPE_ONELEVEL and _RDN.search(fltr):
+            # reads of sibling containers merged into one search of their parent selecting them by their RDNs
+            rdns = set('cn=' + value.lower() for value in _RDN.findall(fltr))
+            return iter([self._read(container) for dn, container in sorted(self.containers.items())
+                         if dn.split(',', 1)[1] == lower and dn.split(',', 1)[0] in rdns])
+        if lower not in self.containers:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+
+        container = self.containers[lower]
+        found = container.find(fltr)
+        if found is not None:
+            return found
+        serials = _SERIALS.findall(fltr)
+        if serials:
+            # certificates selected by ranges of serial numbers, kept prefixed with their number of digits
+            ranges = [(int(low[2:]), int(high[2:])) for low, high in serials]
+            return (container.entry(i) for i in range(container.count) if any(low <= i <= high for low, high in ranges))
+        mark = _MARK.search(fltr)
+        if not mark:
+            return container.entries()
+        attr, value = mark.groups()
+        if attr.lower() == 'entryusn':
+            return container.entries(int(value))
+        return container.entries() if TIMESTAMP >= value else iter([])
+
+
+# counters shared by all connections of a benchmark run
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.entries = 0
+
+    def add(self, searches, entries):
+        with self._lock:
+            self.searches += searches
+            self.entries += entries
+
+
+# stands in for the python-ldap connection, searches are answered from a Directory after the server's latency
+class Connection(object):
+    def __init__(self, directory, latency, stats):
+        self._directory = directory
+        self._latency = latency
+        self._stats = stats
+        self._msgid = itertools.count(1)
+        self._lock = threading.Lock()
+        self._results = {}
+        self._cursors = {}
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who=None, cred=None):
+        time.sleep(self._latency)
+
+    def unbind_s(self):
+        pass
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        paging = None
+        for ctrl in serverctrls or []:
+            if ctrl.controlType == SimplePagedResultsControl.controlType:
+                paging = ctrl
+
+        with self._lock:
+            msgid = next(self._msgid)
+            if paging is not None and paging.cookie:
+                entries = self._cursors.pop(paging.cookie)
+            else:
+                try:
+                    entries = self._directory.search(base, scope, filterstr)
+                except ldap.LDAPError as e:
+                    self._results[msgid] = e
+                    return msgid
+
+            wanted = None if attrlist is None or '*' in attrlist else set(attr.lower() for attr in attrlist)
+            page = list(itertools.islice(entries, paging.size if paging is not None else None))
+            page = [(dn, dict((name, values) for name, values in attrs.items()
+                              if wanted is None or name.lower().partition(';')[0] in wanted)) for dn, attrs in page]
+
+            ctrls = []
+            if paging is not None:
+                cookie = b''
+                following = next(entries, None)
+                if following is not None:
+                    cookie = str(msgid).encode('utf-8')
+                    self._cursors[cookie] = itertools.chain([following], entries)
+                ctrls = [SimplePagedResultsControl(True, size=paging.size, cookie=cookie)]
+            self._results[msgid] = page, ctrls
+        return msgid
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        time.sleep(self._latency)
+        with self._lock:
+            result = self._results.pop(msgid)
+        if isinstance(result, ldap.LDAPError):
+            raise result
+        page, ctrls = result
+        self._stats.add(1, len(page))
+        return ldap.RES_SEARCH_RESULT, page, msgid, ctrls
+
+    def abandon(self, msgid):
+        with self._lock:
+            self._results.pop(msgid, None)
+
+
+def install(directories, latencies, stats):
+    # replaces ldap.initialize so that FreeIPAServer connects to the generated directories
+    def initialize(url, *args, **kwargs):
+        host = url.split('://', 1)[-1]
+        if host not in directories:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        return Connection(directories[host], latencies[host], stats)
+
+    ldap.initialize = initialize
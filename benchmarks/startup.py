@@ -0,0 +1,183 @@
+#  -*- coding: utf-8 -*-
+"""
+Benchmark of the start-up time of Nagios checks answered from the cache
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from prettytable import PrettyTable
+
+from checkipaconsistency.checks import CHECKS as REGISTRY
+
+CHECKS = list(REGISTRY)
+
+# modules a check answered from the cache has no use for
+HEAVY = ['ldap', 'dns', 'prettytable', 'multiprocessing.pool', 'shelve', 'http.server']
+
+# script run in a fresh interpreter for every invocation: times cipa from the first import to its exit and reports
+# the modules it loaded
+CHILD = '''
+import json, sys, time
+start = time.time()
+report = sys.argv[1]
+sys.argv = ['cipa'] + sys.argv[2:]
+from checkipaconsistency.main import main
+try:
+    main()
+except SystemExit:
+    pass
+with open(report, 'w') as f:
+    json.dump({'seconds': time.time() - start, 'modules': sorted(sys.modules)}, f)
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the start-up of Nagios checks answered from the cache')
+    parser.add_argument('--servers', type=int, default=3, help='number of IPA servers (default: 3)')
+    parser.add_argument('--runs', type=int, default=20, help='invocations timed per check (default: 20)')
+    parser.add_argument('--checks', nargs='*', choices=CHECKS + ['all'], default=['users', 'msdcs', 'all'],
+                        help='Nagios checks to time (default: users msdcs all)')
+    parser.add_argument('--budget', type=float,
+                        help='fail if a check takes more than this many milliseconds (median) on top of the '
+                             'interpreter\'s own start-up')
+    parser.add_argument('--json', dest='json_file', help='also write the results to a JSON file')
+    return parser.parse_args()
+
+
+def _warm(argv):
+    # fills the cache from generated directories, in a child process so that the stand-in does not outlive it
+    import dns.resolver
+    from checkipaconsistency.main import Main
+    from .__main__ import _fail_dns
+    from .standin import Directory, Stats, install
+
+    domain, hosts = argv[1], argv[5:]
+    install(dict((host, Directory(host, domain, hosts, users=100, hosts=100, certs=100)) for host in hosts),
+            dict((host, 0) for host in hosts), Stats())
+    dns.resolver.query = _fail_dns
+    sys.argv = ['cipa'] + argv + ['-n', 'users', '--quiet']
+    try:
+        Main().run()
+    except SystemExit:
+        pass
+
+
+def _time(command, report, env):
+    if report is not None and os.path.exists(report):
+        os.remove(report)
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.call(command, env=env, stdout=devnull)
+        wall = time.time() - start
+    if report is None:
+        return wall, None
+    if not os.path.exists(report):
+        print('%s failed' % ' '.join(command), file=sys.stderr)
+        exit(1)
+    with open(report) as f:
+        return wall, json.load(f)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    args = parse_args()
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+    workdir = tempfile.mkdtemp(prefix='cipa-startup-')
+    env = dict(os.environ, XDG_CONFIG_HOME=workdir, XDG_CACHE_HOME=workdir)
+    env['PYTHONPATH'] = os.pathsep.join([os.getcwd()] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    os.environ.update(XDG_CONFIG_HOME=workdir, XDG_CACHE_HOME=workdir)
+
+    domain = 'ipa.example.com'
+    hosts = ['ipa%02d.%s' % (i + 1, domain) for i in range(args.servers)]
+    argv = ['-d', domain, '-W', 'benchmark', '-H'] + hosts
+    # long enough for every timed run to be answered from the cache
+    argv += ['--cache-ttl', '3600']
+    process = context.Process(target=_warm, args=(argv,))
+    process.start()
+    process.join()
+
+    interpreter = [_time([sys.executable, '-c', 'pass'], None, env)[0] for i in range(args.runs)]
+    baseline = _median(interpreter)
+
+    # named after the real script, cipa names its log file after the script it is run from
+    child = os.path.join(workdir, 'cipa')
+    with open(child, 'w') as f:
+        f.write(CHILD)
+    report = os.path.join(workdir, 'report.json')
+    results = []
+    failed = False
+    for check in args.checks:
+        runs = [_time([sys.executable, child, report] + argv + ['-n', check], report, env)
+                for i in range(args.runs)]
+        walls = [wall for wall, child in runs]
+        modules = set(runs[-1][1]['modules'])
+        heavy = [module for module in HEAVY if module in modules]
+        overhead = (_median(walls) - baseline) * 1000
+        if heavy or args.budget is not None and overhead > args.budget:
+            failed = True
+        results.append({
+            'check': check,
+            'median': _median(walls) * 1000,
+            'min': min(walls) * 1000,
+            'overhead': overhead,
+            'cipa': _median([child['seconds'] for wall, child in runs]) * 1000,
+            'modules': len(modules),
+            'heavy': heavy,
+        })
+
+    table = PrettyTable(['Check', 'Median (ms)', 'Min (ms)', 'Over interpreter (ms)', 'In cipa (ms)', 'Modules',
+                         'Heavy modules'])
+    table.align = 'r'
+    table.align['Check'] = table.align['Heavy modules'] = 'l'
+    for result in results:
+        table.add_row([result['check'], '%.1f' % result['median'], '%.1f' % result['min'], '%.1f' % result['overhead'],
+                       '%.1f' % result['cipa'], result['modules'], ' '.join(result['heavy']) or '-'])
+    print('%s servers, %s runs per check, interpreter start-up %.1f ms' % (args.servers, args.runs, baseline * 1000))
+    print(table)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as json_file:
+            json.dump({'parameters': vars(args), 'interpreter': baseline * 1000, 'results': results}, json_file,
+                      indent=2)
+
+    if failed:
+        print('Start-up regressed: heavy modules loaded or budget exceeded', file=sys.stderr)
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
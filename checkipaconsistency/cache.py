@@ -0,0 +1,90 @@
+#  -*- coding: utf-8 -*-
+"""
+Result cache module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+
+# results of the last probe of every cluster, kept for ttl seconds unless they say when they expire; the lock is held
+# from the lookup until the new results are stored, so runs starting while a probe is in progress wait for it instead
+# of probing the servers again; the realms of a multi-realm run share one from their threads
+class ResultCache(object):
+    def __init__(self, path, ttl):
+        self._log = logging.getLogger(__name__)
+        self._path = path
+        self._ttl = ttl
+        self._lock = None
+        self._mutex = threading.Lock()
+
+    def __enter__(self):
+        self._log.debug('Locking result cache %s' % self._path)
+        umask = os.umask(0o077)
+        try:
+            self._lock = open(self._path + '.lock', 'a')
+        finally:
+            os.umask(umask)
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+
+    def _load(self):
+        try:
+            with open(self._path) as cache:
+                return json.load(cache)
+        except (IOError, OSError, ValueError) as e:
+            self._log.debug('Failed to read result cache (%s)' % e)
+            return {}
+
+    def _expired(self, snapshot, now):
+        return now >= snapshot.get('expires', snapshot['time'] + self._ttl)
+
+    def get(self, key):
+        with self._mutex:
+            snapshot = self._load().get(key)
+        if not snapshot or self._expired(snapshot, time.time()):
+            return None
+        return snapshot
+
+    def set(self, key, snapshot):
+        # expired results of other clusters are dropped, the file is replaced in one go so readers never see half of it
+        with self._mutex:
+            now = time.time()
+            data = dict((k, v) for k, v in self._load().items() if not self._expired(v, now))
+            data[key] = snapshot
+            umask = os.umask(0o077)
+            try:
+                with open(self._path + '.tmp', 'w') as cache:
+                    json.dump(data, cache)
+            finally:
+                os.umask(umask)
+            os.rename(self._path + '.tmp', self._path)
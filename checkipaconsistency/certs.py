@@ -0,0 +1,169 @@
+#  -*- coding: utf-8 -*-
+"""
+Certificate repository module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+
+from .checks import value
+from .diff import digest
+
+# attributes of the certificate records read by the certificate mode
+CERT_ATTRS = ['certStatus', 'notBefore', 'notAfter']
+
+# status of the certificates the CA still vouches for
+VALID = 'VALID'
+
+UNKNOWN = 'unknown'
+
+# ranges are summed up with 64-bit digests
+MASK = (1 << 64) - 1
+
+# ranges that differ above which their certificates are listed from a search of the whole repository rather than
+# one selecting the ranges
+MAX_FILTER_RANGES = 100
+
+
+def month(timestamp):
+    # YYYY-MM of a generalized time, unknown if there is none
+    if not timestamp or len(timestamp) < 6 or not timestamp[:6].isdigit():
+        return UNKNOWN
+    return '%s-%s' % (timestamp[:4], timestamp[4:6])
+
+
+def serial(dn):
+    # serial number of a certificate record, whose RDN is cn=<serial number in decimal>
+    number = dn.split(',', 1)[0].partition('=')[2]
+    return int(number) if number.isdigit() else None
+
+
+def serial_value(number):
+    # serialno as Dogtag keeps it, prefixed with its number of digits so that it sorts like the number
+    digits = str(number)
+    return '%02d%s' % (len(digits), digits)
+
+
+def range_key(dn, attrs, by, size):
+    # range of the certificate: its serial number divided by the size of the ranges, or its month of issue
+    if by == 'issued':
+        return month(value(attrs, 'notBefore'))
+    number = serial(dn)
+    return -1 if number is None else number // size
+
+
+def range_label(key, by, size):
+    if by == 'issued':
+        return 'issued %s' % key
+    if key == -1:
+        return 'serial %s' % UNKNOWN
+    return 'serials %s-%s' % (key * size, (key + 1) * size - 1)
+
+
+# reducer for FreeIPAServer.scan() counting the certificates per range, along with the sum of the digests of their
+# serial numbers and statuses so that a certificate revoked on one server only shows too, and per status and month
+# of expiry; the memory it takes grows with the number of ranges and months, not of certificates
+class CertStats(object):
+    def __init__(self, by='serial', size=10000):
+        self._by = by
+        self._size = size
+        self.count = 0
+        # range mapped to the number of certificates in it and the sum of their digests
+        self.ranges = {}
+        # (status, month of expiry) mapped to the number of certificates
+        self.expiry = {}
+
+    def build(self, entries):
+        for dn, attrs in entries:
+            self.count += 1
+            status = value(attrs, 'certStatus', UNKNOWN)
+            key = range_key(dn, attrs, self._by, self._size)
+            count, total = self.ranges.get(key, (0, 0))
+            self.ranges[key] = count + 1, (total + digest('%s:%s' % (dn.lower(), status))) & MASK
+            expiry = status, month(value(attrs, 'notAfter'))
+            self.expiry[expiry] = self.expiry.get(expiry, 0) + 1
+        return self
+
+    def statuses(self):
+        totals = {}
+        for (status, expires), count in self.expiry.items():
+            totals[status] = totals.get(status, 0) + count
+        return totals
+
+    def expiring(self, expires, status=VALID):
+        # certificates of the status expiring in the month
+        return self.expiry.get((status, expires), 0)
+
+    def expired(self, before, status=VALID):
+        # certificates of the status that expired before the month
+        return sum(count for (s, expires), count in self.expiry.items()
+                   if s == status and expires != UNKNOWN and expires < before)
+
+
+def compare_ranges(stats):
+    # ranges whose certificates differ between the servers
+    keys = set()
+    for stat in stats:
+        keys.update(stat.ranges)
+    return sorted(key for key in keys if len(set(stat.ranges.get(key, (0, 0)) for stat in stats)) > 1)
+
+
+def months(start, count):
+    # the count months from the YYYY-MM start on
+    year, number = int(start[:4]), int(start[5:7])
+    found = []
+    for i in range(count):
+        found.append('%04d-%02d' % (year + (number - 1 + i) // 12, (number - 1 + i) % 12 + 1))
+    return found
+
+
+def range_filter(keys, by, size):
+    # filter selecting the certificates in the ranges, None if they cannot all be selected by one
+    if len(keys) > MAX_FILTER_RANGES:
+        return None
+    parts = []
+    for key in keys:
+        if key in (UNKNOWN, -1):
+            return None
+        if by == 'issued':
+            parts.append('(&(notBefore>=%s01000000Z)(!(notBefore>=%s01000000Z)))' %
+                         (key.replace('-', ''), months(key, 2)[1].replace('-', '')))
+        else:
+            parts.append('(&(serialno>=%s)(serialno<=%s))' %
+                         (serial_value(key * size), serial_value((key + 1) * size - 1)))
+    return '(|%s)' % ''.join(parts)
+
+
+# reducer collecting the status of the certificates that fall into the ranges, for listing them
+class CertResolver(object):
+    def __init__(self, keys, by='serial', size=10000):
+        self._keys = set(keys)
+        self._by = by
+        self._size = size
+        # DN mapped to status
+        self.statuses = {}
+
+    def resolve(self, entries):
+        for dn, attrs in entries:
+            if range_key(dn, attrs, self._by, self._size) in self._keys:
+                self.statuses[dn] = value(attrs, 'certStatus', UNKNOWN)
+        return self
@@ -0,0 +1,274 @@
+#  -*- coding: utf-8 -*-
+"""
+Check registry module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import re
+from collections import OrderedDict
+
+# search scopes as numbered by RFC 4511 and python-ldap, which is only imported by the functions that parse DNs so
+# that checks answered from the cache or the daemon do not load it
+SCOPE_BASE, SCOPE_ONELEVEL, SCOPE_SUBTREE = 0, 1, 2
+
+# result of a check that did not finish before the deadline
+TIMED_OUT = 'TIMEOUT'
+
+# result of an expensive check held back because the server was too busy
+POSTPONED = 'BUSY'
+
+# attribute list requesting no attributes at all (RFC 4511), used by searches that only count entries
+NO_ATTRS = ['1.1']
+
+# RUV element of a replica: {replica ID URL} followed by its first and last CSNs, both missing until the replica has
+# made a change
+_RUV_ELEMENT = re.compile(r'\{replica (\d+)(?: ([^}]*))?\}(?: (\w+))?(?: (\w+))?')
+
+# last update statuses of an agreement that is working: success, and replica busy which clears on the next attempt
+HEALTHY_STATUSES = ('0', '18')
+
+# SRV record of the domain controllers of an AD trust, looked up by the msdcs check
+MSDCS_RECORD = '_kerberos._tcp.Default-First-Site-Name._sites.dc._msdcs.%s'
+
+# searches run by the checks: base, filter, attributes, scope; {base_dn} is the domain's suffix and {suffix} the
+# same escaped the way the replica's mapping tree entry is named
+QUERIES = {
+    'fqdn': ('cn=config', '(objectClass=*)', ['nsslapd-localhost'], SCOPE_BASE),
+    'context': ('cn=config', '(objectClass=*)', ['nsslapd-defaultnamingcontext'], SCOPE_BASE),
+    'active_users': ('cn=users,cn=accounts,{base_dn}', '(objectClass=*)', ['numSubordinates'], SCOPE_BASE),
+    'stage_users': ('cn=staged users,cn=accounts,cn=provisioning,{base_dn}', '(objectClass=*)', ['numSubordinates'],
+                    SCOPE_BASE),
+    'preserved_users': ('cn=deleted users,cn=accounts,cn=provisioning,{base_dn}', '(objectClass=*)',
+                        ['numSubordinates'], SCOPE_BASE),
+    'hosts': ('cn=computers,cn=accounts,{base_dn}', '(fqdn=*)', NO_ATTRS, SCOPE_SUBTREE),
+    'services': ('cn=services,cn=accounts,{base_dn}', '(krbprincipalname=*)', NO_ATTRS, SCOPE_SUBTREE),
+    'groups': ('cn=groups,cn=accounts,{base_dn}', '(objectClass=ipausergroup)', NO_ATTRS, SCOPE_SUBTREE),
+    'hostgroups': ('cn=hostgroups,cn=accounts,{base_dn}', '(objectClass=*)', ['numSubordinates'], SCOPE_BASE),
+    'netgroups': ('cn=ng,cn=alt,{base_dn}', '(ipaUniqueID=*)', NO_ATTRS, SCOPE_ONELEVEL),
+    'hbac_rules': ('cn=hbac,{base_dn}', '(ipaUniqueID=*)', NO_ATTRS, SCOPE_ONELEVEL),
+    'sudo_rules': ('cn=sudorules,cn=sudo,{base_dn}', '(ipaUniqueID=*)', NO_ATTRS, SCOPE_ONELEVEL),
+    'dns_zones': ('cn=dns,{base_dn}', '(|(objectClass=idnszone)(objectClass=idnsforwardzone))', NO_ATTRS,
+                  SCOPE_ONELEVEL),
+    'certificates': ('ou=certificateRepository,ou=ca,o=ipaca', '(objectClass=*)', ['numSubordinates'],
+                     SCOPE_BASE),
+    'ldap_conflicts': ('{base_dn}', '(|(nsds5ReplConflict=*)(&(objectclass=ldapsubentry)(nsds5ReplConflict=*)))',
+                       NO_ATTRS, SCOPE_SUBTREE),
+    'ghost_replicas': ('{base_dn}', '(&(objectclass=nstombstone)(nsUniqueId=ffffffff-ffffffff-ffffffff-ffffffff))',
+                       ['nscpentrywsi'], SCOPE_SUBTREE),
+    'monitor': ('cn=monitor', '(objectClass=*)', ['threads', 'opsInitiated', 'opsCompleted', 'currentConnections'],
+                SCOPE_BASE),
+    'last_usn': ('', '(objectClass=*)', ['lastusn'], SCOPE_BASE),
+    'anon_bind': ('cn=config', '(objectClass=*)', ['nsslapd-allow-anonymous-access'], SCOPE_BASE),
+    'ruv': ('nsuniqueid=ffffffff-ffffffff-ffffffff-ffffffff,{base_dn}', '(objectClass=nsTombstone)', ['nsds50ruv'],
+            SCOPE_BASE),
+    'replication_agreements': ('cn=replica,cn={suffix},cn=mapping tree,cn=config', '(objectClass=*)',
+                               ['nsDS5ReplicaHost', 'nsds5replicaLastUpdateStatus'], SCOPE_ONELEVEL),
+    'topology': ('cn=domain,cn=topology,cn=ipa,cn=etc,{base_dn}', '(objectClass=ipaReplTopoSegment)',
+                 ['ipaReplTopoSegmentLeftNode', 'ipaReplTopoSegmentRightNode', 'ipaReplTopoSegmentDirection'],
+                 SCOPE_ONELEVEL),
+}
+
+
+def queries(domain):
+    base_dn = 'dc=' + domain.replace('.', ',dc=')
+    suffix = base_dn.replace('=', '\\3D').replace(',', '\\2C')
+    return dict((name, (base.format(base_dn=base_dn, suffix=suffix), fltr, attrs, scope))
+                for name, (base, fltr, attrs, scope) in QUERIES.items())
+
+
+def values(attrs, name):
+    for attr, attr_values in attrs.items():
+        if attr.lower() == name.lower():
+            return [v.decode('utf-8') for v in attr_values]
+    return []
+
+
+def value(attrs, name, default=None):
+    return (values(attrs, name) or [default])[0]
+
+
+def csn_time(csn):
+    # change sequence numbers start with the time of the change in seconds since the epoch, in hex
+    return int(csn[:8], 16)
+
+
+# reducers turning the entries returned by a check's search into its results, entries is None for checks that do
+# not search the directory
+
+def count_entries(server, entries):
+    return sum(1 for _ in entries)
+
+
+def count_subordinates(server, entries):
+    # base-scope read of the container's numSubordinates, which the server leaves out when it is 0
+    for dn, attrs in entries:
+        return int(value(attrs, 'numSubordinates', '0'))
+    return 0
+
+
+def ghost_replicas(server, entries):
+    r = 0
+    for dn, attrs in entries:
+        for attr in attrs.get('nscpentrywsi', []):
+            if 'replica ' in str(attr) and 'ldap' not in str(attr):
+                r += 1
+        break
+    return r
+
+
+def anon_bind(server, entries):
+    for dn, attrs in entries:
+        state = value(attrs, 'nsslapd-allow-anonymous-access')
+        if state in ['on', 'off', 'rootdse']:
+            return str(state).upper()
+    return 'ERROR'
+
+
+def ms_adtrust(server, entries):
+    for answer in server.srv_records(MSDCS_RECORD % server.domain):
+        if server.fqdn in answer:
+            return True
+    return False
+
+
+def replication_agreements(server, entries):
+    msg = []
+    healthy = True
+    agreements = []
+    for dn, attrs in entries:
+        fqdn = value(attrs, 'nsDS5ReplicaHost')
+        host = fqdn.replace('.%s' % server.domain, '')
+        status = value(attrs, 'nsds5replicaLastUpdateStatus')
+        status = status.replace('Error ', '').partition(' ')[0].strip('()')
+        if status not in HEALTHY_STATUSES:
+            healthy = False
+        msg.append('%s %s' % (host, status))
+        agreements.append([fqdn, status])
+    return '\n'.join(msg), healthy, agreements
+
+
+def ruv(server, entries):
+    # replica update vector of the server, replica IDs mapped to the replica's URL and the first and last CSN of its
+    # changes the server has seen; the lag is worked out by comparing the vectors of all servers
+    replicas = {}
+    for dn, attrs in entries:
+        for element in values(attrs, 'nsds50ruv'):
+            match = _RUV_ELEMENT.match(element)
+            if match:
+                rid, url, first, last = match.groups()
+                replicas[rid] = [url, first, last]
+    return None, replicas
+
+
+class Check(object):
+    # results are the names of the values the reducer returns (a tuple when there is more than one), default are
+    # the values reported when the server could not be contacted and failed the ones when the search failed;
+    # expensive checks search the whole directory and are held back on busy servers
+    def __init__(self, name, title, query, reducer, results=None, default=None, failed=None, expensive=False):
+        self.name = name
+        self.title = title
+        self.query = query
+        self.reducer = reducer
+        self.results = results or (name,)
+        self.default = default or (None,) * len(self.results)
+        self.failed = failed or (0,) * len(self.results)
+        self.expensive = expensive
+
+
+# adding a check takes a query above and an entry here, the table and the Nagios plugin list the checks in this order
+CHECKS = OrderedDict((check.name, check) for check in [
+    Check('users', 'Active Users', 'active_users', count_subordinates),
+    Check('susers', 'Stage Users', 'stage_users', count_subordinates),
+    Check('pusers', 'Preserved Users', 'preserved_users', count_subordinates),
+    Check('hosts', 'Hosts', 'hosts', count_entries),
+    Check('services', 'Services', 'services', count_entries),
+    Check('ugroups', 'User Groups', 'groups', count_entries),
+    Check('hgroups', 'Host Groups', 'hostgroups', count_subordinates),
+    Check('ngroups', 'Netgroups', 'netgroups', count_entries),
+    Check('hbac', 'HBAC Rules', 'hbac_rules', count_entries),
+    Check('sudo', 'SUDO Rules', 'sudo_rules', count_entries),
+    Check('zones', 'DNS Zones', 'dns_zones', count_entries),
+    Check('certs', 'Certificates', 'certificates', count_subordinates),
+    Check('conflicts', 'LDAP Conflicts', 'ldap_conflicts', count_entries, expensive=True),
+    Check('ghosts', 'Ghost Replicas', 'ghost_replicas', ghost_replicas, expensive=True),
+    Check('bind', 'Anonymous BIND', 'anon_bind', anon_bind, failed=('ERROR',)),
+    Check('msdcs', 'Microsoft ADTrust', None, ms_adtrust),
+    Check('replicas', 'Replication Status', 'replication_agreements', replication_agreements,
+          results=('replicas', 'healthy_agreements', 'agreements'), default=(None, False, None),
+          failed=('ERROR', False, None)),
+    Check('lag', 'Replication Lag', 'ruv', ruv, results=('lag', 'ruv'), failed=(None, None)),
+])
+
+# check results mapped to the checks computing them
+RESULTS = dict((result, check) for check in CHECKS.values() for result in check.results)
+
+# checks counting entries mapped to the search selecting them, used to scan the entries
+ENTRY_CHECKS = OrderedDict((name, check.query) for name, check in CHECKS.items()
+                           if check.reducer in (count_entries, count_subordinates) and name != 'conflicts')
+
+
+def normalize_dn(dn):
+    import ldap.dn
+    return ','.join(rdn.lower() for rdn in ldap.dn.explode_dn(dn))
+
+
+# merges the searches of the named queries into as few LDAP operations as possible, returns a list of the searches
+# to run along with the queries answered by each and the DN of the entry answering it (None when the query gets
+# all the entries the search returns)
+def plan(named_queries):
+    import ldap.dn
+    import ldap.filter
+    operations = []
+    reads = OrderedDict()
+    for name, (base, fltr, attrs, scope) in named_queries:
+        if scope == SCOPE_BASE and fltr == '(objectClass=*)':
+            base, read_attrs, names = reads.setdefault(normalize_dn(base), (base, OrderedDict(), []))
+            for attr in attrs:
+                read_attrs.setdefault(attr.lower(), attr)
+            names.append(name)
+        else:
+            operations.append(((base, fltr, attrs, scope), [(name, None)]))
+
+    # reads of the same entry become one read of all the attributes they need, reads of sibling entries needing the
+    # same attributes become one search of their parent's children selecting them by their RDNs, which does not
+    # return any other entry of the tree
+    groups = OrderedDict()
+    for dn, (base, attrs, names) in reads.items():
+        rdns = ldap.dn.explode_dn(base)
+        key = tuple(sorted(attrs)), ','.join(rdns[1:]).lower()
+        groups.setdefault(key, (list(attrs.values()), []))[1].append((dn, base, rdns, names))
+
+    for attrs, entries in groups.values():
+        # multi-valued and escaped RDNs are left alone rather than turned into filters
+        if len(entries) == 1 or len(entries[0][2]) < 2 or \
+                any('+' in rdns[0] or '\\' in rdns[0] for dn, base, rdns, names in entries):
+            for dn, base, rdns, names in entries:
+                operations.append(((base, '(objectClass=*)', attrs, SCOPE_BASE),
+                                   [(name, dn) for name in names]))
+            continue
+        parent = ','.join(entries[0][2][1:])
+        fltr = '(|%s)' % ''.join('(%s=%s)' % (rdns[0].split('=', 1)[0], ldap.filter.escape_filter_chars(
+            rdns[0].split('=', 1)[1])) for dn, base, rdns, names in entries)
+        operations.append(((parent, fltr, attrs, SCOPE_ONELEVEL),
+                           [(name, dn) for dn, base, rdns, names in entries for name in names]))
+    return operations
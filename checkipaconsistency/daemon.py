@@ -0,0 +1,135 @@
+#  -*- coding: utf-8 -*-
+"""
+Daemon module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+# stands in for a FreeIPAServer when the results come from the daemon
+class ServerSnapshot(object):
+    def __init__(self, hostname_short, results):
+        self.hostname_short = hostname_short
+        for check, value in results.items():
+            setattr(self, check, value)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.sendall(self.server.content)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        os.unlink(self.server_address)
+
+
+def unix_server(path):
+    # socket serving the latest results as JSON to every client connecting, readable by its owner only
+    log = logging.getLogger(__name__)
+    socket_dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(socket_dir):
+        log.debug('Socket directory %s does not exist, creating' % socket_dir)
+        os.makedirs(socket_dir)
+    if os.path.exists(path):
+        log.debug('Removing stale socket %s' % path)
+        os.unlink(path)
+
+    umask = os.umask(0o077)
+    try:
+        return _UnixServer(path, _Handler)
+    finally:
+        os.umask(umask)
+
+
+def encode(snapshot):
+    return json.dumps(snapshot).encode('utf-8')
+
+
+# keeps refreshing the results in the background while the server hands out the latest content rendered from them,
+# so the clients never wait for the servers to be probed and never cause a probe themselves
+class Daemon(object):
+    def __init__(self, server, interval, refresh, content):
+        self._server = server
+        self._interval = interval
+        self._refresh = refresh
+        self._server.content = content
+
+    def _refresher(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                content = self._refresh()
+            except (Exception, SystemExit):
+                # the refresh has logged the failure already, keep serving the previous results
+                continue
+            self._server.content = content
+
+    def serve_forever(self):
+        refresher = threading.Thread(target=self._refresher)
+        refresher.daemon = True
+        refresher.start()
+
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+
+def query(path, timeout=5):
+    # returns the daemon's latest results, None if there is no daemon listening on the socket
+    log = logging.getLogger(__name__)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    data = b''
+    try:
+        sock.connect(path)
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data.decode('utf-8'))
+    except (socket.error, ValueError) as e:
+        log.debug('Failed to query daemon on %s (%s)' % (path, e))
+        return None
+    finally:
+        sock.close()
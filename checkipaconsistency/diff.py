@@ -0,0 +1,237 @@
+#  -*- coding: utf-8 -*-
+"""
+Entry diff module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import bisect
+import hashlib
+import heapq
+import struct
+from array import array
+
+# entryUSN is assigned locally by every server, modifyTimestamp is replicated along with the change
+STATE_ATTR = 'modifyTimestamp'
+
+# nsUniqueId is replicated along with the entry and kept when it is renamed, entries are keyed by it, or by their DN
+# when it is not returned
+KEY_ATTR = 'nsUniqueId'
+
+# attributes read for indexing entries
+INDEX_ATTRS = [STATE_ATTR, KEY_ATTR]
+
+# depth of the digest trees, a tree has 2 ** DEPTH leaf buckets of 8 bytes each
+DEPTH = 10
+
+try:
+    array('Q')
+    TYPECODE = 'Q'
+except ValueError:
+    TYPECODE = 'L'
+
+
+def digest(value):
+    # DNs come back as byte strings from python-ldap 2 on Python 2, they are hashed as they are
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return struct.unpack('>Q', hashlib.sha256(value).digest()[:8])[0]
+
+
+def entry_digest(key, state):
+    return struct.unpack('>Q', hashlib.sha256(struct.pack('>QQ', key, state)).digest()[:8])[0]
+
+
+def bucket(key, depth=DEPTH):
+    # leaf bucket of an entry key, taken from its top bits
+    return key >> (64 - depth)
+
+
+def entry_key(dn, attrs):
+    for attr, values in attrs.items():
+        if attr.lower() == KEY_ATTR.lower():
+            return digest(values[0].decode('utf-8').lower())
+    return digest(dn.lower())
+
+
+def entry_state(attrs):
+    for attr, values in attrs.items():
+        if attr.lower() == STATE_ATTR.lower():
+            return values[0].decode('utf-8')
+    return ''
+
+
+# sorted 64-bit digests of the keys of the entries in a subtree along with the digests of their state
+class EntryIndex(object):
+    def __init__(self):
+        self._keys = array(TYPECODE)
+        self._states = array(TYPECODE)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return zip(self._keys, self._states)
+
+    def build(self, entries):
+        # reducer for FreeIPAServer.scan(), the entries are consumed as they are streamed
+        for dn, attrs in entries:
+            self.append(dn, attrs)
+        return self.finish()
+
+    def append(self, dn, attrs):
+        self._keys.append(entry_key(dn, attrs))
+        self._states.append(digest(entry_state(attrs)))
+
+    def finish(self):
+        order = sorted(range(len(self._keys)), key=self._keys.__getitem__)
+        self._keys = array(TYPECODE, (self._keys[i] for i in order))
+        self._states = array(TYPECODE, (self._states[i] for i in order))
+        return self
+
+    def update(self, dn, attrs):
+        # adds or replaces a single entry of a finished index
+        key = entry_key(dn, attrs)
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            self._states[i] = digest(entry_state(attrs))
+        else:
+            self._keys.insert(i, key)
+            self._states.insert(i, digest(entry_state(attrs)))
+
+    def remove(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            self._keys.pop(i)
+            self._states.pop(i)
+
+    def tree(self, depth=DEPTH):
+        tree = DigestTree(depth)
+        for key, state in self:
+            tree.add(key, state)
+        return tree.finish()
+
+
+# Merkle-style tree of XOR-combined entry digests bucketed by entry key, each node is the XOR of its children so
+# equal subtrees have equal nodes regardless of the order the entries were streamed in; with keep, the DN and state
+# of every entry are kept by leaf bucket while it is built, so that the buckets that differ can be resolved without
+# searching the server again
+class DigestTree(object):
+    def __init__(self, depth=DEPTH, keep=False):
+        self.depth = depth
+        self.count = 0
+        self.levels = [array(TYPECODE, [0]) * (2 ** depth)]
+        self._entries = {} if keep else None
+
+    @property
+    def root(self):
+        return self.levels[0][0]
+
+    def add(self, key, state):
+        self.levels[-1][bucket(key, self.depth)] ^= entry_digest(key, state)
+        self.count += 1
+
+    def build(self, entries):
+        # reducer for FreeIPAServer.scan(), only the leaf buckets are kept while the entries are streamed
+        for dn, attrs in entries:
+            key, state = entry_key(dn, attrs), entry_state(attrs)
+            self.add(key, digest(state))
+            if self._entries is not None:
+                self._entries.setdefault(bucket(key, self.depth), []).append((key, dn, state))
+        return self.finish()
+
+    def resolve(self, buckets):
+        # resolver of the entries kept in the buckets, None if the entries were not kept
+        if self._entries is None:
+            return None
+        resolver = EntryResolver(lambda key: True)
+        for n in buckets:
+            for key, dn, state in self._entries.get(n, ()):
+                resolver.dns[key] = dn
+                resolver.states[key] = state
+        return resolver
+
+    def finish(self):
+        del self.levels[:-1]
+        while len(self.levels[0]) > 1:
+            below = self.levels[0]
+            self.levels.insert(0, array(TYPECODE, (below[i] ^ below[i + 1] for i in range(0, len(below), 2))))
+        return self
+
+
+# walks the trees from the root down, descending only into nodes whose digests differ, returns the set of leaf
+# buckets that differ and the number of levels compared
+def compare_trees(trees):
+    nodes = [0]
+    for level in range(trees[0].depth + 1):
+        nodes = [n for n in nodes if len(set(tree.levels[level][n] for tree in trees)) > 1]
+        if not nodes or level == trees[0].depth:
+            return set(nodes), level + 1
+        nodes = [child for n in nodes for child in (2 * n, 2 * n + 1)]
+
+
+# reducer mapping the entry keys accepted by match back to DNs and their state
+class EntryResolver(object):
+    def __init__(self, match):
+        self._match = match
+        self.dns = {}
+        self.states = {}
+
+    def resolve(self, entries):
+        for dn, attrs in entries:
+            key = entry_key(dn, attrs)
+            if self._match(key):
+                self.dns[key] = dn
+                self.states[key] = entry_state(attrs)
+        return self
+
+
+def _tagged(index, tag):
+    for key, state in index:
+        yield key, state, tag
+
+
+# merges a list of indexes and returns the entry keys that are missing from some of them or whose state differs,
+# mapped to the set of positions of the indexes holding them
+def compare(indexes):
+    differences = {}
+    merged = heapq.merge(*[_tagged(index, i) for i, index in enumerate(indexes)])
+    key, states, holders = None, set(), set()
+
+    for next_key, state, i in merged:
+        if next_key != key:
+            if key is not None and (len(holders) != len(indexes) or len(states) > 1):
+                differences[key] = holders
+            key, states, holders = next_key, set(), set()
+        states.add(state)
+        holders.add(i)
+
+    if key is not None and (len(holders) != len(indexes) or len(states) > 1):
+        differences[key] = holders
+    return differences
+
+
+# entry keys whose state differs between the resolvers or that some of the resolvers have not seen
+def compare_resolved(resolvers):
+    keys = set()
+    for resolver in resolvers:
+        keys.update(resolver.states)
+    return set(key for key in keys if len(set(resolver.states.get(key) for resolver in resolvers)) > 1)
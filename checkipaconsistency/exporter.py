@@ -0,0 +1,158 @@
+#  -*- coding: utf-8 -*-
+"""
+Prometheus exporter module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import logging
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_HISTOGRAMS = {
+    'ldap': ('cipa_ldap_search_duration_seconds', 'Time from sending an LDAP search until its last entry arrived'),
+    'dns': ('cipa_dns_query_duration_seconds', 'Time taken by a DNS query'),
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in sorted(labels.items()))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        content = self.server.content
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, fmt, *args):
+        logging.getLogger(__name__).debug('%s %s' % (self.address_string(), fmt % args))
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def http_server(listen):
+    # listen is [address]:port, all addresses when the address is left out
+    address, _, port = listen.rpartition(':')
+    return _HTTPServer((address.strip('[]'), int(port)), _Handler)
+
+
+# latency histograms accumulated over all probes, rendered along with the results of the last one
+class Metrics(object):
+    def __init__(self):
+        self._histograms = {}
+
+    def observe(self, kind, server, query, seconds):
+        histogram = self._histograms.setdefault((kind, server, query), [[0] * len(BUCKETS), 0.0, 0])
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def render(self, snapshot, consistent, duration):
+        lines = [
+            '# HELP cipa_check_value Value of the check on the server',
+            '# TYPE cipa_check_value gauge',
+        ]
+        info = []
+        for server in snapshot['servers']:
+            for check, value in sorted(server['results'].items()):
+                labels = _labels(server=server['hostname_short'], check=check)
+                if value is None or isinstance(value, dict):
+                    continue
+                elif isinstance(value, (bool, int, float)):
+                    lines.append('cipa_check_value%s %s' % (labels, int(value)))
+                else:
+                    # results that are not numbers are exposed as labels
+                    info.append('cipa_check_info%s 1' %
+                                _labels(server=server['hostname_short'], check=check, value=value))
+        lines += ['# HELP cipa_check_info Result of the check on the server that is not a number',
+                  '# TYPE cipa_check_info gauge'] + info
+
+        lines += ['# HELP cipa_replication_lag_seconds How far the server is behind the changes made on the replica',
+                  '# TYPE cipa_replication_lag_seconds gauge']
+        for server in snapshot['servers']:
+            for replica, seconds in sorted(server['results'].get('replica_lag', {}).items()):
+                lines.append('cipa_replication_lag_seconds%s %s' %
+                             (_labels(server=server['hostname_short'], replica=replica), seconds))
+
+        topology = snapshot.get('topology')
+        if topology:
+            lines += ['# HELP cipa_topology_broken_agreements Agreements of the replication topology that are failing',
+                      '# TYPE cipa_topology_broken_agreements gauge',
+                      'cipa_topology_broken_agreements %s' % len(topology['broken']),
+                      '# HELP cipa_topology_unreachable_replicas Replicas of the topology that could not be reached',
+                      '# TYPE cipa_topology_unreachable_replicas gauge',
+                      'cipa_topology_unreachable_replicas %s' % len(topology['unreachable']),
+                      '# HELP cipa_topology_partitions Groups of replicas whose changes do not reach one another',
+                      '# TYPE cipa_topology_partitions gauge',
+                      'cipa_topology_partitions %s' % len(topology['partitions'])]
+
+        lines += ['# HELP cipa_check_consistent Whether the check is consistent across all servers',
+                  '# TYPE cipa_check_consistent gauge']
+        for check, state in consistent.items():
+            lines.append('cipa_check_consistent%s %s' % (_labels(check=check), int(state)))
+
+        lines += ['# HELP cipa_probe_timestamp_seconds Time the last probe finished',
+                  '# TYPE cipa_probe_timestamp_seconds gauge',
+                  'cipa_probe_timestamp_seconds %.3f' % snapshot['time'],
+                  '# HELP cipa_probe_duration_seconds Time the last probe took',
+                  '# TYPE cipa_probe_duration_seconds gauge',
+                  'cipa_probe_duration_seconds %.6f' % duration]
+
+        for kind in sorted(_HISTOGRAMS):
+            name, text = _HISTOGRAMS[kind]
+            lines += ['# HELP %s %s' % (name, text), '# TYPE %s histogram' % name]
+            for (k, server, query), (buckets, total, count) in sorted(self._histograms.items()):
+                if k != kind:
+                    continue
+                for bound, n in zip(BUCKETS, buckets):
+                    lines.append('%s_bucket%s %s' % (name, _labels(server=server, query=query, le=bound), n))
+                lines.append('%s_bucket%s %s' % (name, _labels(server=server, query=query, le='+Inf'), count))
+                lines.append('%s_sum%s %.6f' % (name, _labels(server=server, query=query), total))
+                lines.append('%s_count%s %s' % (name, _labels(server=server, query=query), count))
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
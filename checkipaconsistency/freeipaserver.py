@@ -23,79 +23,420 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from __future__ import print_function
+import functools
 import logging
+import re
+import time
 import ldap
-import dns.resolver
+from ldap.controls import SimplePagedResultsControl
+from collections import OrderedDict
+
+from .checks import CHECKS, ENTRY_CHECKS, NO_ATTRS, POSTPONED, RESULTS, TIMED_OUT, normalize_dn, plan, queries, value
+from .resolver import Resolver
+
+# seconds waited before each expensive check on a server as busy as the load limit, less on quieter servers
+PACE = 1.0
+
+# attributes tested by a filter
+_FILTER_ATTRS = re.compile(r'\(([\w;-]+)[~<>]?=')
+
+
+class DeadlineExceeded(Exception):
+    pass
 
 
 class FreeIPAServer(object):
-    def __init__(self, host, domain, binddn, bindpw):
+    # checks counting entries mapped to the search (see checks.QUERIES) selecting them, used by scan()
+    entry_checks = ENTRY_CHECKS
+
+    def __init__(self, host, domain, binddn, bindpw, page_size=1000, profile=False, deadline=None, checks=(),
+                 resolver=None, max_load=None, concurrency=None, listener=None):
         self._log = logging.getLogger(__name__)
         self._log.debug('Initialising FreeIPA server %s' % host)
 
-        self.users = None
-        self.susers = None
-        self.pusers = None
-        self.hosts = None
-        self.services = None
-        self.ugroups = None
-        self.hgroups = None
-        self.ngroups = None
-        self.hbac = None
-        self.sudo = None
-        self.zones = None
-        self.certs = None
-        self.conflicts = None
-        self.ghosts = None
-        self.bind = None
-        self.msdcs = None
-        self.replicas = None
-        self.healthy_agreements = False
-
         self._binddn = binddn
         self._bindpw = bindpw
         self._domain = domain
+        self._page_size = page_size
         self._url = 'ldaps://' + host
         self.hostname_short = host.replace('.%s' % domain, '')
-        self._conn = self._get_conn()
+        self._profile = profile
+        # called with the server and the name of every check whose results have just been computed
+        self._listener = listener
+        # shared with the other servers so that each DNS name is only looked up once
+        self._resolver = resolver or Resolver()
+        # time by which all checks have to be done, checks still running then are reported as timed out
+        self._deadline = deadline
+        self._timed_out = False
+        # (kind, query, seconds, entries, bytes) of every LDAP search and DNS query completed, bytes are only
+        # counted when profiling
+        self.latencies = []
+        # time, queries, entries and bytes per check when profiling
+        self.profile = OrderedDict()
+        self._pending = {}
+        # at most concurrency searches are in progress on the server at once, counting the ones being collected,
+        # the others wait here to be sent
+        self._concurrency = concurrency
+        self._deferred = OrderedDict()
+        self._collecting = 0
+        # share of the server's worker threads busy above which expensive checks are postponed, the load read from
+        # cn=monitor and the pause before each expensive check
+        self._max_load = max_load
+        self.load = None
+        self._pace = None
+        self._base_dn = 'dc=' + self._domain.replace('.', ',dc=')
+        # searches run by the checks, see checks.QUERIES
+        self._queries = queries(domain)
+        self._query_names = dict((self._search_key(*query), name) for name, query in self._queries.items())
+        # queries sent so far mapped to the search answering them and the DN of their entry, and the entries of
+        # the merged searches already collected
+        self._planned = {}
+        self._merged = {}
+        # content synchronization sessions keeping the entries of checks counting them, see persist()
+        self._sessions = {}
+
+        start = time.time()
+        try:
+            self._conn = self._get_conn()
+            if self._conn:
+                # the checks reading single entries are sent along with the server's identity so that their reads
+                # are merged with it, the load goes first so that they do not count towards it
+                self._send_queries((['monitor'] if self._throttled(checks) else []) + ['fqdn', 'context'] +
+                                   [q for q in self._check_queries(checks) if self._queries[q][3] == ldap.SCOPE_BASE])
+                self._fqdn = self._query('fqdn', self._get_fqdn)
+                context = self._query('context', self._get_context)
+        except DeadlineExceeded:
+            self._log.debug('Deadline exceeded while connecting to %s' % self._url)
+            self._timed_out = True
+            self._conn = False
 
         if not self._conn:
+            self._record('connect', start, 0)
             return
 
-        self._fqdn = self._get_fqdn()
         self.hostname_short = self._fqdn.replace('.%s' % domain, '')
 
         self._log.debug('FQDN: %s, short hostname: %s' % (self._fqdn, self.hostname_short))
 
-        self._base_dn = 'dc=' + self._domain.replace('.', ',dc=')
-
-        context = self._get_context()
         if self._base_dn != context:
             self._log.critical('Context mismatch: %s vs %s' % (self._base_dn, context))
             exit(1)
+        self._record('connect', start, 0)
+
+    def __getattr__(self, name):
+        # only called for attributes not set yet, i.e. check results that have not been computed; each check runs
+        # the first time one of its results is read and the results are memoized as instance attributes
+        check = RESULTS.get(name)
+        if check is None:
+            raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+        try:
+            if self._timed_out:
+                raise DeadlineExceeded()
+            count = self._live_count(check.name)
+            if count is not None:
+                results = (count,)
+            elif self._conn and check.expensive and self._postponed():
+                results = (POSTPONED,) + check.default[1:]
+            elif self._conn:
+                results = self._profiled(check.name, self._run_check, check)
+            else:
+                results = check.default
+        except DeadlineExceeded:
+            self._expire()
+            results = (TIMED_OUT,) + check.default[1:]
+
+        for n, result in zip(check.results, results):
+            setattr(self, n, result)
+        if self._listener:
+            self._listener(self, check.name)
+        return getattr(self, name)
+
+    @property
+    def domain(self):
+        return self._domain
+
+    @property
+    def fqdn(self):
+        return self._fqdn
+
+    @property
+    def connected(self):
+        return bool(self._conn)
+
+    def reset(self, deadline=None):
+        # forgets the memoized check results so that they are computed again on the same connection
+        self._deadline = deadline
+        self._timed_out = False
+        for name in RESULTS:
+            self.__dict__.pop(name, None)
+        self._pending = {}
+        self._deferred = OrderedDict()
+        self._planned = {}
+        self._merged = {}
+        self.load = None
+        self._pace = None
+        self.latencies = []
+        self.profile = OrderedDict()
+
+    def _record(self, name, start, first):
+        # adds the time since start and the queries completed since the first one to the profile of name
+        if not self._profile:
+            return
+        record = self.profile.setdefault(name, {'time': 0.0, 'queries': 0, 'entries': 0, 'bytes': 0})
+        record['time'] += time.time() - start
+        for kind, query, seconds, entries, size in self.latencies[first:]:
+            record['queries'] += 1
+            record['entries'] += entries
+            record['bytes'] += size
+
+    def _profiled(self, name, method, *args):
+        start, first = time.time(), len(self.latencies)
+        try:
+            return method(*args)
+        finally:
+            self._record(name, start, first)
+
+    def _remaining(self):
+        # seconds left until the deadline, None if there is none
+        if self._deadline is None:
+            return None
+        remaining = self._deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return remaining
+
+    def _expire(self):
+        # the deadline has passed, stop the searches still running on the server
+        if not self._timed_out:
+            self._log.debug('Deadline exceeded on %s, abandoning %s pending searches' % (self._url, len(self._pending)))
+        self._timed_out = True
+        if self._conn:
+            for msgid, start in self._pending.values():
+                self._conn.abandon(msgid)
+        self._pending = {}
+        self._deferred = OrderedDict()
+
+    def _cost(self, check):
+        # checks reading single entries go before the ones searching whole subtrees
+        query = CHECKS[RESULTS[check].name].query
+        return 0 if query and self._queries[query][3] == ldap.SCOPE_BASE else 1
+
+    def _check_queries(self, checks):
+        # queries of the checks whose results have not been computed yet, nor are kept by a session
+        names = set(RESULTS[check].name for check in checks)
+        return [check.query for check in CHECKS.values()
+                if check.name in names and check.query and check.results[0] not in self.__dict__ and
+                check.name not in self._sessions]
+
+    def persist(self, checks):
+        # keeps the entries of the checks counting them one by one in content synchronization sessions (RFC 4533
+        # refreshAndPersist, see syncrepl.SyncSession), whose counts are used instead of searching the server once
+        # their first refresh is done; sessions that ended are restarted
+        if not self._conn:
+            return
+        from .syncrepl import SyncSession
+        for check in checks:
+            if check not in self.entry_checks or not self.counts_entries(check):
+                continue
+            if check not in self._sessions:
+                base, fltr, scope = self._entry_search(check)
+                self._sessions[check] = SyncSession(self._url, self._binddn, self._bindpw, base, fltr, scope,
+                                                    '%s %s' % (self.hostname_short, check))
+            self._sessions[check].start()
+
+    def _live_count(self, check):
+        # count of the check's entries kept by its session, None if there is none or it is not following changes
+        session = self._sessions.get(check)
+        if session is None:
+            return None
+        count = session.count(self._remaining())
+        if count is None:
+            self._log.debug('%s: %s not synchronized, searching' % (self.hostname_short, check))
+        return count
+
+    def fetch(self, checks):
+        self._log.debug('Fetching checks: %s' % ', '.join(checks))
+        if self._deadline is not None and self._conn:
+            # collect the cheap checks first so that as many as possible finish within the deadline
+            checks = sorted(checks, key=self._cost)
+        if self._conn and self._throttled(checks):
+            self._measure_load()
+        if self._conn and not self._timed_out:
+            # send all searches up front so that they are processed while the results are being collected, apart
+            # from the expensive ones of a throttled server, which are run one at a time if at all
+            queries = self._check_queries(checks)
+            if self.load is not None:
+                queries = [q for q in queries if not any(c.expensive for c in CHECKS.values() if c.query == q)]
+            self._send_queries(queries)
+        for check in checks:
+            getattr(self, check)
+
+    def _throttled(self, checks):
+        # whether the expensive checks among the checks depend on the server's load
+        return bool(self._max_load) and any(RESULTS[check].expensive for check in checks)
+
+    def _measure_load(self):
+        try:
+            self._send_queries(['monitor'])
+            load = self._query('monitor', self._get_load)
+        except DeadlineExceeded:
+            # the checks report the timeout
+            self._expire()
+            return
+        if load is False or load is None:
+            self._log.debug('Load of %s unknown, not throttling' % self._url)
+            return
+        self.load = load
+        if load < self._max_load:
+            self._pace = PACE * load / self._max_load
+            self._log.debug('Load of %s is %.2f, pausing %.2f seconds before each expensive check' %
+                            (self._url, load, self._pace))
+        else:
+            self._log.debug('Load of %s is %.2f, postponing expensive checks' % (self._url, load))
+
+    def topology(self):
+        # segments of the domain's replication topology, the same on every server as FreeIPA replicates them; False
+        # if they could not be read
+        if not self._conn or self._timed_out:
+            return False
+        try:
+            self._send_queries(['topology'])
+            return self._profiled('topology', self._query, 'topology', self._get_segments)
+        except DeadlineExceeded:
+            self._expire()
+            return False
+
+    def _postponed(self):
+        # whether an expensive check is held back, after pausing when it is not
+        if self.load is None:
+            return False
+        if self.load >= self._max_load:
+            return True
+        remaining = self._remaining()
+        time.sleep(self._pace if remaining is None else min(self._pace, remaining))
+        return False
+
+    def _send_queries(self, names):
+        # plans the queries not sent yet into as few searches as possible (see checks.plan) and sends them
+        names = [name for name in names if name not in self._planned]
+        for search, answers in plan((name, self._queries[name]) for name in names):
+            if len(answers) > 1:
+                self._query_names[self._search_key(*search)] = '+'.join(name for name, dn in answers)
+            for name, dn in answers:
+                self._planned[name] = search, dn
+            self._send(*search)
+
+    def _query(self, name, reducer):
+        # runs the query through the reducer, returns False if the search failed
+        search, dn = self._planned.get(name, (self._queries[name], None))
+        if dn is None:
+            return self._search(*search, reducer=reducer)
+        key = self._search_key(*search)
+        if key not in self._merged:
+            self._merged[key] = self._search(*search)
+        if self._merged[key] is False:
+            return False
+        return reducer(entry for entry in self._merged[key] if normalize_dn(entry[0]) == dn)
+
+    def _run_check(self, check):
+        self._log.debug('Running check %s...' % check.name)
+        reducer = functools.partial(check.reducer, self)
+        if not check.query:
+            results = reducer(None)
+        else:
+            results = self._query(check.query, reducer)
+            if results is False:
+                results = check.failed
+        if len(check.results) == 1 and results is not check.failed:
+            results = (results,)
+        self._log.debug(results)
+        return results
 
-        self._active_user_base = 'cn=users,cn=accounts,' + self._base_dn
-        self._stage_user_base = 'cn=staged users,cn=accounts,cn=provisioning,' + self._base_dn
-        self._preserved_user_base = 'cn=deleted users,cn=accounts,cn=provisioning,' + self._base_dn
-        self._groups_base = 'cn=groups,cn=accounts,' + self._base_dn
-
-        self.users = self._count_users(user_base='active')
-        self.susers = self._count_users(user_base='stage')
-        self.pusers = self._count_users(user_base='preserved')
-        self.hosts = self._count_hosts()
-        self.services = self._count_services()
-        self.ugroups = self._count_groups()
-        self.hgroups = self._count_hostgroups()
-        self.ngroups = self._count_netgroups()
-        self.hbac = self._count_hbac_rules()
-        self.sudo = self._count_sudo_rules()
-        self.zones = self._count_dns_zones()
-        self.certs = self._count_certificates()
-        self.conflicts = self._count_ldap_conflicts()
-        self.ghosts = self._ghost_replicas()
-        self.bind = self._anon_bind()
-        self.msdcs = self._ms_adtrust()
-        self.replicas, self.healthy_agreements = self._replication_agreements()
+    def counts_entries(self, check):
+        # whether the check counts the entries returned by a search rather than reading numSubordinates
+        return bool(self._conn) and self._queries[self.entry_checks[check]][3] != ldap.SCOPE_BASE
+
+    def _entry_search(self, check):
+        base, fltr, attrs, scope = self._queries[self.entry_checks[check]]
+        if scope == ldap.SCOPE_BASE:
+            # numSubordinates read of the container, list its children instead
+            fltr, scope = '(objectClass=*)', ldap.SCOPE_ONELEVEL
+        return base, fltr, scope
+
+    def last_usn(self, check):
+        # last USN handed out by the backend holding the check's entries (lastusn of the root DSE), None if it is
+        # not known
+        if not self._conn:
+            return None
+        backend = 'ipaca' if normalize_dn(self._entry_search(check)[0]).endswith('o=ipaca') else 'userroot'
+        usns = self._query('last_usn', self._get_last_usn)
+        if not usns:
+            return None
+        # the USN plugin in global mode keeps a single lastusn for all backends
+        return usns.get(backend, usns.get(None))
+
+    @staticmethod
+    def _get_last_usn(entries):
+        usns = {}
+        for dn, attrs in entries:
+            for attr, attr_values in attrs.items():
+                name, _, backend = attr.lower().partition(';')
+                if name == 'lastusn' and attr_values:
+                    usns[backend or None] = int(attr_values[0])
+        return usns
+
+    def scan(self, check, reducer, attrs=None, fltr=None):
+        # streams the entries counted by the check, optionally narrowed down by an additional filter, through the
+        # reducer, returns False if the search failed
+        if not self._conn:
+            return False
+        base, check_fltr, scope = self._entry_search(check)
+        if fltr:
+            check_fltr = '(&%s%s)' % (check_fltr, fltr)
+        return self._profiled(check, self._search, base, check_fltr, attrs or NO_ATTRS, scope, reducer)
+
+    def scan_tombstones(self, check, reducer, attrs=None, fltr=None):
+        # same for the tombstones left behind by entries deleted from the check's container, these sit one level
+        # below the original entry so the whole subtree is searched; 389-DS keeps the object classes of the entry on
+        # its tombstone, so a check filter testing object classes only narrows them down to the check's entries,
+        # any other filter is left out and the tombstones of the container's other entries are returned too
+        if not self._conn:
+            return False
+        base, check_fltr = self._entry_search(check)[:2]
+        if check_fltr.lower() == '(objectclass=*)' or \
+                set(attr.lower() for attr in _FILTER_ATTRS.findall(check_fltr)) != set(['objectclass']):
+            check_fltr = ''
+        return self._profiled(check, self._search, base, '(&(objectClass=nsTombstone)%s%s)' % (check_fltr, fltr or ''),
+                              attrs or NO_ATTRS, ldap.SCOPE_SUBTREE, reducer)
+
+    def read(self, check, dns, attrs, batch=100):
+        # reads the entries with the DNs, every batch merged into as few searches as possible (see checks.plan) and
+        # all of them sent up front, returns the attributes of the entries found by normalized DN or False if the
+        # server could not be searched
+        if not self._conn:
+            return False
+        searches = []
+        for i in range(0, len(dns), batch):
+            searches += plan((dn, (dn, '(objectClass=*)', attrs, ldap.SCOPE_BASE)) for dn in dns[i:i + batch])
+        for search, answers in searches:
+            self._send(*search)
+
+        found = {}
+        for search, answers in searches:
+            wanted = set(dn for name, dn in answers)
+
+            def collect(entries):
+                for dn, entry in entries:
+                    key = normalize_dn(dn)
+                    if key in wanted:
+                        found[key] = entry
+
+            # entries that do not exist fail their search, the connection going away fails the read
+            self._profiled(check, self._search, *(search + (collect,)))
+            if not self._conn:
+                return False
+        return found
 
     @staticmethod
     def _get_ldap_msg(e):
@@ -114,9 +455,14 @@ class FreeIPAServer(object):
 
         try:
             conn = ldap.initialize(self._url)
-            conn.set_option(ldap.OPT_NETWORK_TIMEOUT, 3)
+            remaining = self._remaining()
+            conn.set_option(ldap.OPT_NETWORK_TIMEOUT, 3 if remaining is None else min(3, remaining))
+            if remaining is not None:
+                conn.set_option(ldap.OPT_TIMEOUT, remaining)
             conn.set_option(ldap.OPT_REFERRALS, ldap.OPT_OFF)
             conn.simple_bind_s(self._binddn, self._bindpw)
+        except ldap.TIMEOUT:
+            raise DeadlineExceeded()
         except (
             ldap.SERVER_DOWN,
             ldap.NO_SUCH_OBJECT,
@@ -132,12 +478,106 @@ class FreeIPAServer(object):
         self._log.debug('LDAP connection established')
         return conn
 
-    def _search(self, base, fltr, attrs=None, scope=ldap.SCOPE_SUBTREE):
-        self._log.debug('Search base: %s, filter: %s, attributes: %s, scope: %s' % (base, fltr, attrs, scope))
+    @staticmethod
+    def _search_key(base, fltr, attrs, scope):
+        return base, fltr, tuple(attrs) if attrs else None, scope
+
+    def _send_page(self, base, fltr, attrs, scope, cookie=''):
+        # everything but base-scope reads uses the Simple Paged Results control (RFC 2696), so that no single
+        # response holds more than one page of entries and the server's size limit does not truncate the results
+        ctrls = None
+        if scope != ldap.SCOPE_BASE:
+            ctrls = [SimplePagedResultsControl(True, size=self._page_size, cookie=cookie)]
+        return self._conn.search_ext(base, scope, fltr, attrs, serverctrls=ctrls)
+
+    def _send(self, base, fltr, attrs=None, scope=ldap.SCOPE_SUBTREE):
+        key = self._search_key(base, fltr, attrs, scope)
+        if key in self._pending:
+            return
+        if not self._slot_free():
+            self._deferred[key] = base, fltr, attrs, scope
+            return
+        self._log.debug('Sending search base: %s, filter: %s, attributes: %s, scope: %s' % (base, fltr, attrs, scope))
         try:
-            results = self._conn.search_s(base, scope, fltr, attrs)
-        except (ldap.NO_SUCH_OBJECT, ldap.SERVER_DOWN) as e:
+            start = time.time()
+            self._pending[key] = self._send_page(base, fltr, attrs, scope), start
+        except ldap.LDAPError as e:
+            # leave it to _search to run the search again and deal with the error
             self._log.debug(self._get_ldap_msg(e))
+
+    def _slot_free(self):
+        return not self._concurrency or len(self._pending) + self._collecting < self._concurrency
+
+    def _requeue(self):
+        # the search sent last gives its slot up to the one needed now, it is abandoned and sent again first
+        key = max(self._pending, key=lambda k: self._pending[k][1])
+        msgid, start = self._pending.pop(key)
+        self._conn.abandon(msgid)
+        base, fltr, attrs, scope = key
+        self._log.debug('Requeueing search base: %s, filter: %s (msgid %s)' % (base, fltr, msgid))
+        deferred = [(key, (base, fltr, list(attrs) if attrs else None, scope))]
+        self._deferred = OrderedDict(deferred + list(self._deferred.items()))
+
+    def _search_iter(self, base, fltr, attrs=None, scope=ldap.SCOPE_SUBTREE):
+        key = self._search_key(base, fltr, attrs, scope)
+        self._remaining()
+        self._deferred.pop(key, None)
+        msgid, start = self._pending.pop(key, (None, None))
+        if msgid is None and self._pending and not self._slot_free():
+            self._requeue()
+
+        entries, size = 0, 0
+        self._collecting += 1
+        try:
+            if msgid is None:
+                self._log.debug('Search base: %s, filter: %s, attributes: %s, scope: %s' % (base, fltr, attrs, scope))
+                start = time.time()
+                msgid = self._send_page(base, fltr, attrs, scope)
+            else:
+                self._log.debug('Collecting search base: %s, filter: %s, attributes: %s, scope: %s (msgid %s)' %
+                                (base, fltr, attrs, scope, msgid))
+            while msgid is not None:
+                rtype, rdata, rmsgid, ctrls = self._conn.result3(msgid, timeout=self._remaining())
+                msgid = None
+                for dn, entry in rdata:
+                    # search continuation references come back without a DN
+                    if dn is not None:
+                        entries += 1
+                        if self._profile:
+                            size += self._entry_size(dn, entry)
+                        yield dn, entry
+                for ctrl in ctrls:
+                    if ctrl.controlType == SimplePagedResultsControl.controlType and ctrl.cookie:
+                        msgid = self._send_page(base, fltr, attrs, scope, cookie=ctrl.cookie)
+        finally:
+            self._collecting -= 1
+            # the consumer stopped early, do not leave the next page running on the server
+            if msgid is not None:
+                self._conn.abandon(msgid)
+            # searches run outside the checks are named after their base
+            self.latencies.append(('ldap', self._query_names.get(key, base), time.time() - start, entries, size))
+            # a slot is free, send the searches waiting for one
+            while self._deferred and self._slot_free():
+                self._send(*self._deferred.popitem(last=False)[1])
+
+    @staticmethod
+    def _entry_size(dn, entry):
+        # approximate size of the entry on the wire, without the BER encoding overhead
+        return len(dn) + sum(len(attr) + sum(len(value) for value in values) for attr, values in entry.items())
+
+    def _search(self, base, fltr, attrs=None, scope=ldap.SCOPE_SUBTREE, reducer=list):
+        # results are streamed through the reducer, which gets an iterator of (dn, attrs) tuples
+        try:
+            results = reducer(self._search_iter(base, fltr, attrs, scope))
+        except ldap.TIMEOUT:
+            raise DeadlineExceeded()
+        except ldap.NO_SUCH_OBJECT as e:
+            self._log.debug(self._get_ldap_msg(e))
+            results = False
+        except ldap.SERVER_DOWN as e:
+            # the connection is gone, do not wait for it to time out again on every remaining search
+            self._log.debug('%s (%s)' % (self._get_ldap_msg(e), self._url))
+            self._conn = False
             results = False
         except ldap.REFERRAL as e:
             self._log.critical("Replica %s is temporarily unavailable." % self._fqdn)
@@ -146,289 +586,52 @@ class FreeIPAServer(object):
             exit(1)
         return results
 
-    def _get_fqdn(self):
-        self._log.debug('Grabbing FQDN from LDAP')
-        results = self._search(
-            'cn=config',
-            '(objectClass=*)',
-            ['nsslapd-localhost'],
-            scope=ldap.SCOPE_BASE
-        )
-
-        if not results and type(results) is not list:
-            r = None
-        else:
-            dn, attrs = results[0]
-            r = attrs['nsslapd-localhost'][0].decode('utf-8')
-
-        self._log.debug(r)
+    def _get_load(self, entries):
+        # share of the worker threads busy with operations other than this read
+        r = None
+        for dn, attrs in entries:
+            threads = int(value(attrs, 'threads', '0'))
+            running = int(value(attrs, 'opsInitiated', '0')) - int(value(attrs, 'opsCompleted', '0')) - 1
+            self._log.debug('%s: %s operations in progress on %s threads, %s connections' %
+                            (self.hostname_short, running, threads, value(attrs, 'currentConnections')))
+            if threads:
+                r = max(running, 0) / float(threads)
         return r
 
-    def _get_context(self):
-        self._log.debug('Grabbing default context from LDAP')
-        results = self._search(
-            'cn=config',
-            '(objectClass=*)',
-            ['nsslapd-defaultnamingcontext'],
-            scope=ldap.SCOPE_BASE
-        )
-
-        if not results and type(results) is not list:
-            r = None
-        else:
-            dn, attrs = results[0]
-            r = attrs['nsslapd-defaultnamingcontext'][0].decode('utf-8')
-
-        self._log.debug(r)
+    def _get_segments(self, entries):
+        r = [(value(attrs, 'ipaReplTopoSegmentLeftNode'), value(attrs, 'ipaReplTopoSegmentRightNode'),
+              value(attrs, 'ipaReplTopoSegmentDirection')) for dn, attrs in entries]
+        self._log.debug('%s: %s topology segments' % (self.hostname_short, len(r)))
         return r
 
-    def _count_users(self, user_base):
-        self._log.debug('Counting %s users...' % user_base)
-        results = self._search(
-            getattr(self, '_%s_user_base' % user_base),
-            '(objectClass=*)',
-            ['numSubordinates'],
-            scope=ldap.SCOPE_BASE
-        )
-
-        if not results and type(results) is not list:
-            r = 0
-        else:
-            dn, attrs = results[0]
-            r = attrs['numSubordinates'][0].decode('utf-8')
-
-        self._log.debug(r)
-        return r
-
-    def _count_groups(self):
-        self._log.debug('Counting groups...')
-        results = self._search(
-            self._groups_base,
-            '(objectClass=ipausergroup)'
-        )
-
-        if not results and type(results) is not list:
-            r = 0
-        else:
-            r = len(results)
-
-        self._log.debug(r)
-        return r
-
-    def _count_hosts(self):
-        self._log.debug('Counting hosts...')
-        results = self._search(
-            'cn=computers,cn=accounts,%s' % self._base_dn,
-            '(fqdn=*)',
-            ['dn']
-        )
-
-        if not results and type(results) is not list:
-            r = 0
-        else:
-            r = len(results)
-
-        self._log.debug(r)
-        return r
-
-    def _count_services(self):
-        self._log.debug('Counting services...')
-        results = self._search(
-            'cn=services,cn=accounts,%s' % self._base_dn,
-            '(krbprincipalname=*)',
-            ['dn']
-        )
-
-        if not results and type(results) is not list:
-            r = 0
-        else:
-            r = len(results)
-
-        self._log.debug(r)
-        return r
-
-    def _count_netgroups(self):
-        self._log.debug('Counting netgroups...')
-        results = self._search(
-            'cn=ng,cn=alt,%s' % self._base_dn,
-            '(ipaUniqueID=*)',
-            ['dn'],
-            scope=ldap.SCOPE_ONELEVEL
-        )
-
-        if not results and type(results) is not list:
-            r = 0
-        else:
-            r = len(results)
-
-        self._log.debug(r)
-        return r
-
-    def _count_hostgroups(self):
-        self._log.debug('Counting host groups...')
-        results = self._search(
-            'cn=hostgroups,cn=accounts,%s' % self._base_dn,
-            '(objectClass=*)',
-            ['numSubordinates'],
-            scope=ldap.SCOPE_BASE
-        )
-        dn, attrs = results[0]
-        r = attrs['numSubordinates'][0].decode('utf-8')
-        self._log.debug(r)
-        return r
-
-    def _count_hbac_rules(self):
-        self._log.debug('Counting HBAC rules...')
-        results = self._search(
-            'cn=hbac,%s' % self._base_dn,
-            '(ipaUniqueID=*)',
-            scope=ldap.SCOPE_ONELEVEL
-        )
-        r = len(results)
-        self._log.debug(r)
-        return r
-
-    def _count_sudo_rules(self):
-        self._log.debug('Counting SUDO rules...')
-        results = self._search(
-            'cn=sudorules,cn=sudo,%s' % self._base_dn,
-            '(ipaUniqueID=*)',
-            scope=ldap.SCOPE_ONELEVEL
-        )
-        r = len(results)
-        self._log.debug(r)
-        return r
-
-    def _count_dns_zones(self):
-        self._log.debug('Counting DNS zones...')
-        results = self._search(
-            'cn=dns,%s' % self._base_dn,
-            '(|(objectClass=idnszone)(objectClass=idnsforwardzone))',
-            scope=ldap.SCOPE_ONELEVEL
-        )
-        if not results and type(results) is not list:
-            r = 0
-        else:
-            r = len(results)
-        self._log.debug(r)
-        return r
-
-    def _count_certificates(self):
-        self._log.debug('Counting certificates...')
-        results = self._search(
-            'ou=certificateRepository,ou=ca,o=ipaca',
-            '(certStatus=*)',
-            ['subjectName'],
-            scope=ldap.SCOPE_ONELEVEL
-        )
-
-        if not results and type(results) is not list:
-            r = 0
-        else:
-            r = len(results)
-
-        self._log.debug(r)
-        return r
-
-    def _count_ldap_conflicts(self):
-        self._log.debug('Checking for LDAP conflicts...')
-        results = self._search(
-            self._base_dn,
-            '(|(nsds5ReplConflict=*)(&(objectclass=ldapsubentry)(nsds5ReplConflict=*)))',
-            ['nsds5ReplConflict']
-        )
-
-        if not results and type(results) is not list:
-            r = 0
-        else:
-            r = len(results)
-
-        self._log.debug(r)
-        return r
-
-    def _ghost_replicas(self):
-        self._log.debug('Checking for ghost replicas...')
-        results = self._search(
-            self._base_dn,
-            '(&(objectclass=nstombstone)(nsUniqueId=ffffffff-ffffffff-ffffffff-ffffffff))',
-            ['nscpentrywsi']
-        )
-
-        r = 0
-
-        if type(results) == list and len(results) > 0:
-            dn, attrs = results[0]
-
-            for attr in attrs['nscpentrywsi']:
-                if 'replica ' in str(attr) and 'ldap' not in str(attr):
-                    r += 1
-
+    def _get_fqdn(self, entries):
+        self._log.debug('Grabbing FQDN from LDAP')
+        r = None
+        for dn, attrs in entries:
+            r = value(attrs, 'nsslapd-localhost')
         self._log.debug(r)
         return r
 
-    def _anon_bind(self):
-        self._log.debug('Checking for anonymous bind...')
-        results = self._search(
-            'cn=config',
-            '(objectClass=*)',
-            ['nsslapd-allow-anonymous-access'],
-            scope=ldap.SCOPE_BASE
-        )
-        dn, attrs = results[0]
-        state = attrs['nsslapd-allow-anonymous-access'][0].decode('utf-8')
-
-        if state in ['on', 'off', 'rootdse']:
-            r = str(state).upper()
-        else:
-            r = 'ERROR'
-
+    def _get_context(self, entries):
+        self._log.debug('Grabbing default context from LDAP')
+        r = None
+        for dn, attrs in entries:
+            r = value(attrs, 'nsslapd-defaultnamingcontext')
         self._log.debug(r)
         return r
 
-    def _ms_adtrust(self):
-        self._log.debug('Checking for MS ADTrust DNS records...')
-        record = '_kerberos._tcp.Default-First-Site-Name._sites.dc._msdcs.%s' % self._domain
-
-        r = False
-
+    def srv_records(self, record):
+        # SRV records of the name as text, empty if there are none; only lookups sent by this server are recorded,
+        # not the answers kept by the resolver
+        import dns.exception
+        start = time.time()
         try:
-            answers = dns.resolver.query(record, 'SRV')
-        except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers):
-            self._log.debug(r)
-            return r
-
-        for answer in answers:
-            if self._fqdn in answer.to_text():
-                r = True
-                self._log.debug(r)
-                return r
-
-        self._log.debug(r)
-        return r
-
-    def _replication_agreements(self):
-        self._log.debug('Checking for replication agreements...')
-        msg = []
-        healthy = True
-        suffix = self._base_dn.replace('=', '\\3D').replace(',', '\\2C')
-        results = self._search(
-            'cn=replica,cn=%s,cn=mapping tree,cn=config' % suffix,
-            '(objectClass=*)',
-            ['nsDS5ReplicaHost', 'nsds5replicaLastUpdateStatus'],
-            scope=ldap.SCOPE_ONELEVEL
-        )
-
-        for result in results:
-            dn, attrs = result
-            host = attrs['nsDS5ReplicaHost'][0].decode('utf-8')
-            host = host.replace('.%s' % self._domain, '')
-            status = attrs['nsds5replicaLastUpdateStatus'][0].decode('utf-8')
-            status = status.replace('Error ', '').partition(' ')[0].strip('()')
-            if status not in ['0', '18']:
-                healthy = False
-            msg.append('%s %s' % (host, status))
-
-        r1 = '\n'.join(msg)
-        r2 = healthy
-        self._log.debug('%s, %s' % (r1, r2))
-        return r1, r2
+            records, queried = self._resolver.lookup(record, lifetime=self._remaining())
+        except dns.exception.Timeout:
+            self.latencies.append(('dns', 'msdcs', time.time() - start, 0, 0))
+            if self._deadline is None:
+                raise
+            raise DeadlineExceeded()
+        if queried:
+            self.latencies.append(('dns', 'msdcs', time.time() - start, 0, 0))
+        return records
@@ -22,11 +22,15 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from __future__ import absolute_import, print_function
+import errno
+import functools
+import json
 import os
+import socket
 import sys
+import threading
+import time
 import argparse
-from prettytable import PrettyTable
-import dns.resolver
 from collections import OrderedDict
 
 try:
@@ -36,32 +40,136 @@ except ImportError:
 
 from pplogger import get_logger
 from .__version__ import __version__
-from .freeipaserver import FreeIPAServer
+from .checks import CHECKS, ENTRY_CHECKS, MSDCS_RECORD, TIMED_OUT, POSTPONED, csn_time, normalize_dn
+from .daemon import Daemon, ServerSnapshot, encode, query, unix_server
+from .cache import ResultCache
+from .resolver import Resolver
 
-
-class Checks(object):
-    def __init__(self):
-        pass
+# python-ldap, dnspython, prettytable, the thread pool and the modules of the other modes are imported where they are
+# first needed, so that a Nagios check answered from the cache or the daemon starts without loading any of them
 
 
 class Main(object):
-    def __init__(self):
-        self._app_name = os.path.basename(sys.modules['__main__'].__file__)
-        self._app_dir = os.path.dirname(os.path.realpath(__file__))
-        self._parse_args()
-        self._log = get_logger(debug=self._args.debug, quiet=self._args.quiet, verbose=self._args.verbose,
-                               file_level='DEBUG' if self._args.log_file else False,
-                               log_file=self._args.log_file if self._args.log_file else False)
-        self._log.debug(self._args)
-        self._log.debug('Initialising...')
+    # subtrees compared by --digest when no checks are given
+    _digest_checks = ['users', 'hosts', 'services', 'ugroups', 'certs']
+
+    # result cache entry keeping the DNS answers between Nagios checks
+    _dns_cache_key = 'dns'
+
+    # results reported along with a check's value in NDJSON records
+    _extras = {
+        'replicas': ['healthy_agreements'],
+        'lag': ['replica_lag'],
+    }
+
+    def __init__(self, realm=None, parent=None):
+        # a realm of a multi-realm run shares the arguments, logger, DNS answers, worker pool, state file and result
+        # cache of the parent probing all of them
+        self._start = time.time()
+        self._realm = realm
+        self._parent = parent
+        if parent is None:
+            self._app_name = os.path.basename(sys.modules['__main__'].__file__)
+            self._app_dir = os.path.dirname(os.path.realpath(__file__))
+            self._parse_args()
+            self._log = get_logger(debug=self._args.debug, quiet=self._args.quiet, verbose=self._args.verbose,
+                                   file_level='DEBUG' if self._args.log_file else False,
+                                   log_file=self._args.log_file if self._args.log_file else False)
+            self._log.debug(self._args)
+        else:
+            self._app_name, self._app_dir, self._args, self._log = \
+                parent._app_name, parent._app_dir, parent._args, parent._log
+        self._log.debug('Initialising...' if realm is None else 'Initialising realm %s...' % realm)
 
         self._domain = None
         self._hosts = []
         self._binddn = 'cn=Directory Manager'
         self._bindpw = None
+        self._threads = 10
+        self._page_size = 1000
+        self._state_file = None
+        self._resync = 86400
+        self._socket = None
+        self._interval = 60
+        self._deadline = None
+        self._cache_file = self._default_path('cache')
+        self._cache_ttl = 60
+        self._max_load = 0.75
+        self._concurrency = []
+        self._workers = 20
+        self._realm_names = []
 
         self._load_config()
 
+        self._checks = OrderedDict((name, check.title) for name, check in CHECKS.items())
+
+        if self._args.socket is not None:
+            self._log.debug('Socket set by argument')
+            self._socket = self._args.socket
+
+        if self._args.deadline is not None:
+            self._log.debug('Deadline set by argument')
+            self._deadline = self._args.deadline
+
+        if self._deadline is not None and self._deadline <= 0:
+            self._log.critical('Incorrect deadline: %s' % self._deadline)
+            exit(1)
+
+        if self._args.syncrepl and not (self._args.daemon or self._args.exporter):
+            self._log.critical('Content synchronization needs daemon or exporter mode')
+            exit(1)
+
+        if self._args.interval is not None:
+            self._log.debug('Refresh interval set by argument')
+            self._interval = self._args.interval
+
+        if self._args.max_load is not None:
+            self._log.debug('Maximum load set by argument')
+            self._max_load = self._args.max_load
+
+        if self._max_load < 0:
+            self._log.critical('Incorrect maximum load: %s' % self._max_load)
+            exit(1)
+
+        if self._args.concurrency is not None:
+            self._log.debug('Concurrency set by argument')
+            self._concurrency = self._args.concurrency
+
+        self._concurrency_limits = {}
+        for limit in self._concurrency:
+            host, _, n = limit.rpartition(':')
+            if not n.isdigit() or int(n) < 1:
+                self._log.critical('Incorrect concurrency: %s' % limit)
+                exit(1)
+            self._concurrency_limits[host] = int(n)
+
+        self._state = None
+        self._servers = OrderedDict()
+        # report of the replication topology (see topology.Topology.report), None until the replicas are checked
+        self._topology = None
+        self._realms = OrderedDict()
+        self._pool = None
+        self._shared_cache = None
+        self._resolver = Resolver() if parent is None else parent._resolver
+        # (host, check) of the NDJSON records written so far
+        self._emitted = set()
+        self._emit_lock = threading.Lock() if parent is None else parent._emit_lock
+        # set once the reader of the records has gone away, e.g. head, nothing more is written then
+        self._output_closed = False
+        self._duration = 0
+
+        if parent is None and self._args.realms is not None:
+            self._probe_realms()
+            return
+
+        # diff and digest modes need the entries themselves, the daemon only keeps the check results of one domain
+        if self._socket and parent is None and not (
+                self._args.daemon or self._args.exporter or self._args.diff_check or self._args.sample_check or
+                self._args.digest_checks is not None or self._args.cert_stats or self._args.profile is not None):
+            self._servers = self._query_daemon() or OrderedDict()
+            if self._servers:
+                return
+
         if self._args.domain:
             self._log.debug('Domain set by argument')
             self._domain = self._args.domain
@@ -81,22 +189,6 @@ class Main(object):
                 self._log.critical('Incorrect server name: %s' % host)
                 exit(1)
 
-        if not self._hosts:
-            self._log.debug('Searching for IPA servers in DNS')
-            record = '_ldap._tcp.%s' % self._domain
-            answers = []
-
-            try:
-                answers = dns.resolver.query(record, 'SRV')
-            except (dns.resolver.NXDOMAIN, dns.resolver.NoNameservers):
-                self._log.critical('IPA servers not set, also failed to find any in DNS')
-                exit(1)
-
-            for answer in answers:
-                self._hosts.append(str(answer).split(' ')[3].rstrip('.'))
-
-        self._log.debug('IPA servers: %s' % ', '.join(self._hosts))
-
         if self._args.binddn:
             self._log.debug('Bind DN set by argument')
             self._binddn = self._args.binddn
@@ -113,29 +205,140 @@ class Main(object):
             self._log.critical('Bind password not set')
             exit(1)
 
-        self._servers = OrderedDict()
-        for host in self._hosts:
-            self._servers[host] = FreeIPAServer(host, self._domain, self._binddn, self._bindpw)
-
-        self._checks = OrderedDict([
-            ('users', 'Active Users'),
-            ('susers', 'Stage Users'),
-            ('pusers', 'Preserved Users'),
-            ('hosts', 'Hosts'),
-            ('services', 'Services'),
-            ('ugroups', 'User Groups'),
-            ('hgroups', 'Host Groups'),
-            ('ngroups', 'Netgroups'),
-            ('hbac', 'HBAC Rules'),
-            ('sudo', 'SUDO Rules'),
-            ('zones', 'DNS Zones'),
-            ('certs', 'Certificates'),
-            ('conflicts', 'LDAP Conflicts'),
-            ('ghosts', 'Ghost Replicas'),
-            ('bind', 'Anonymous BIND'),
-            ('msdcs', 'Microsoft ADTrust'),
-            ('replicas', 'Replication Status')
-        ])
+        if self._args.threads is not None:
+            self._log.debug('Number of threads set by argument')
+            self._threads = self._args.threads
+
+        if self._threads < 1:
+            self._log.critical('Incorrect number of threads: %s' % self._threads)
+            exit(1)
+
+        if self._args.page_size is not None:
+            self._log.debug('Page size set by argument')
+            self._page_size = self._args.page_size
+
+        if self._page_size < 1:
+            self._log.critical('Incorrect page size: %s' % self._page_size)
+            exit(1)
+
+        self._init_storage()
+
+        if self._cache:
+            self._servers = self._cached_servers()
+        else:
+            self._discover_servers()
+            start = time.time()
+            self._servers = self._probe_servers()
+            self._duration = time.time() - start
+
+    def _init_storage(self):
+        if self._args.state_file is not None:
+            self._log.debug('State file set by argument')
+            self._state_file = self._args.state_file
+
+        if self._args.resync is not None:
+            self._log.debug('Resync interval set by argument')
+            self._resync = self._args.resync
+
+        if self._args.cache_file is not None:
+            self._log.debug('Cache file set by argument')
+            self._cache_file = self._args.cache_file
+
+        if self._args.cache_ttl is not None:
+            self._log.debug('Cache TTL set by argument')
+            self._cache_ttl = self._args.cache_ttl
+
+        # only Nagios checks share results, each of them needs a single value but fills the cache for the others
+        self._cache = bool(self._args.nagios_check and self._cache_file and self._cache_ttl > 0 and
+                           not self._args.no_cache and self._args.profile is None)
+
+        if self._parent is not None:
+            # the state file and the result cache are the parent's, whatever the realm's section says
+            self._state_file, self._state = self._parent._state_file, self._parent._state
+            self._cache_file, self._cache_ttl, self._cache = \
+                self._parent._cache_file, self._parent._cache_ttl, self._parent._cache
+            self._shared_cache = self._parent._shared_cache
+        elif self._state_file:
+            state_dir = os.path.dirname(os.path.abspath(self._state_file))
+            if not os.path.exists(state_dir):
+                self._log.debug('State directory %s does not exist, creating' % state_dir)
+                os.makedirs(state_dir)
+            from .state import StateFile
+            self._state = StateFile(self._state_file).open()
+
+    def _probe_realms(self):
+        # every realm is probed by a thread of its own, their servers by the worker pool they share
+        if self._args.domain or self._args.hosts:
+            self._log.critical('The domain and servers of a realm are set in its IPA:<realm> config section')
+            exit(1)
+
+        if self._args.daemon or self._args.exporter or self._args.diff_check or self._args.sample_check or \
+                self._args.digest_checks is not None or self._args.cert_stats or self._args.profile is not None:
+            self._log.critical('Realm mode only supports table, JSON and Nagios plugin output')
+            exit(1)
+
+        names = self._args.realms or self._realm_names
+        if not names:
+            self._log.critical('No realms set, add IPA:<realm> sections to the config file')
+            exit(1)
+
+        for name in names:
+            if name not in self._realm_names:
+                self._log.critical('Realm %s not found in the config file' % name)
+                exit(1)
+
+        if self._args.workers is not None:
+            self._log.debug('Number of workers set by argument')
+            self._workers = self._args.workers
+
+        if self._workers < 1:
+            self._log.critical('Incorrect number of workers: %s' % self._workers)
+            exit(1)
+
+        self._init_storage()
+
+        def probe(name):
+            try:
+                self._realms[name] = Main(realm=name, parent=self)
+            except SystemExit:
+                # the realm has logged why
+                pass
+            except Exception as e:
+                self._log.error('Realm %s failed (%s)' % (name, e))
+
+        from multiprocessing.pool import ThreadPool
+        self._log.debug('Probing %s realms using %s shared threads' % (len(names), self._workers))
+        self._pool = ThreadPool(self._workers)
+        start = time.time()
+        try:
+            if self._cache:
+                # locked once for all the realms, each looks up and stores its own results
+                with self._result_cache() as self._shared_cache:
+                    self._run_threads(probe, names)
+            else:
+                self._run_threads(probe, names)
+        finally:
+            self._pool.close()
+            self._pool.join()
+        self._duration = time.time() - start
+        self._realms = OrderedDict((name, self._realms.get(name)) for name in names)
+
+    @staticmethod
+    def _run_threads(func, items):
+        threads = [threading.Thread(target=func, args=(item,)) for item in items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def _seconds(value):
+        return float(value[:-1] if value.endswith('s') else value)
+
+    @staticmethod
+    def _default_path(ext):
+        return os.path.join(os.path.expanduser(os.environ.get('XDG_CACHE_HOME', '~/.cache')),
+                            '%s.%s' % (os.path.splitext(__name__)[0], ext))
 
     def _parse_args(self):
         parser = argparse.ArgumentParser(description='Tool to check consistency across FreeIPA servers', add_help=False)
@@ -143,6 +346,50 @@ class Main(object):
         parser.add_argument('-d', '--domain', nargs='?', dest='domain', help='IPA domain')
         parser.add_argument('-D', '--binddn', nargs='?', dest='binddn', help='Bind DN (default: cn=Directory Manager)')
         parser.add_argument('-W', '--bindpw', nargs='?', dest='bindpw', help='Bind password')
+        parser.add_argument('-t', '--threads', type=int, dest='threads',
+                            help='number of IPA servers to probe in parallel (default: 10), per realm in realm mode')
+        parser.add_argument('-r', '--realm', nargs='*', dest='realms', metavar='REALM',
+                            help='check the realms set in IPA:<realm> config sections concurrently (all by default)')
+        parser.add_argument('--workers', type=int, dest='workers',
+                            help='number of threads shared by the realms in realm mode (default: 20)')
+        parser.add_argument('-p', '--page-size', type=int, dest='page_size',
+                            help='number of entries per page of LDAP search results (default: 1000)')
+        parser.add_argument('-s', '--state-file', nargs='?', dest='state_file', default='not_set',
+                            help='keep entry indexes in a state file and only fetch changes on later runs '
+                                 '(%s by default)' % self._default_path('state'))
+        parser.add_argument('--resync', type=int, dest='resync',
+                            help='seconds after which the state is rebuilt from a full scan (default: 86400)')
+        parser.add_argument('--daemon', action='store_true', dest='daemon',
+                            help='keep probing the servers and serve the results on the socket')
+        parser.add_argument('-S', '--socket', nargs='?', dest='socket', default='not_set',
+                            help='get the results from a daemon listening on the socket, or listen on it in daemon '
+                                 'mode (%s by default)' % self._default_path('sock'))
+        parser.add_argument('--exporter', nargs='?', dest='exporter', default='not_set',
+                            help='keep probing the servers and serve the results as Prometheus metrics on '
+                                 '[ADDRESS]:PORT (:9479 by default)')
+        parser.add_argument('--deadline', type=self._seconds, dest='deadline',
+                            help='seconds (e.g. 8 or 8s) the checks have to finish in, checks still running then are '
+                                 'reported as timed out')
+        parser.add_argument('--max-load', type=float, dest='max_load',
+                            help='share of a server\'s worker threads busy above which its expensive checks are '
+                                 'postponed, 0 to never throttle them (default: 0.75)')
+        parser.add_argument('--concurrency', nargs='*', dest='concurrency', metavar='[HOST:]N',
+                            help='number of searches in progress at once on every server, or on the given one')
+        parser.add_argument('--interval', type=int, dest='interval',
+                            help='seconds between refreshes in daemon and exporter modes (default: 60)')
+        parser.add_argument('--syncrepl', action='store_true', dest='syncrepl',
+                            help='keep the entries counted one by one in content synchronization sessions (RFC 4533) '
+                                 'in daemon and exporter modes instead of searching them on every refresh')
+        parser.add_argument('--cache-file', dest='cache_file',
+                            help='file sharing the results between Nagios checks (default: %s)' %
+                                 self._default_path('cache'))
+        parser.add_argument('--cache-ttl', type=int, dest='cache_ttl',
+                            help='seconds the results are shared between Nagios checks for (default: 60)')
+        parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+                            help='always probe the servers in Nagios plugin mode')
+        parser.add_argument('--profile', nargs='?', dest='profile', default='not_set',
+                            help='print the time, queries, entries and bytes of every check on every server, '
+                                 'optionally writing them to a JSON file too')
         parser.add_argument('--help', action='help', help='show this help message and exit')
         parser.add_argument('--version', action='version',
                             version='%s %s' % (os.path.basename(sys.argv[0]), __version__))
@@ -151,16 +398,44 @@ class Main(object):
         parser.add_argument('--quiet', action='store_true', dest='quiet', help='do not log to console')
         parser.add_argument('-l', '--log-file', nargs='?', dest='log_file', default='not_set',
                             help='log to file (./%s.log by default)' % self._app_name)
+        parser.add_argument('-o', '--output', dest='output', default='table', choices=['table', 'json', 'ndjson'],
+                            help='output format: a table, a JSON document, or a JSON record per line written as '
+                                 'soon as each result is known (default: %(default)s)')
         parser.add_argument('--no-header', action='store_true', dest='disable_header', help='disable table header')
         parser.add_argument('--no-border', action='store_true', dest='disable_border', help='disable table border')
         parser.add_argument('-n', nargs='?', dest='nagios_check', help='Nagios plugin mode', default='not_set',
-                            choices=['', 'all', 'users', 'susers', 'pusers', 'hosts', 'services', 'ugroups', 'hgroups',
-                                     'ngroups', 'hbac', 'sudo', 'zones', 'certs', 'conflicts', 'ghosts', 'bind',
-                                     'msdcs', 'replicas'])
+                            choices=['', 'all'] + list(CHECKS))
+        parser.add_argument('--diff', dest='diff_check', choices=list(ENTRY_CHECKS),
+                            help='list entries of the check that are missing or stale on any of the servers')
+        parser.add_argument('--digest', nargs='*', dest='digest_checks', choices=list(ENTRY_CHECKS),
+                            help='compare bucketed digests of the checks\' entries (default: %s)' %
+                                 ' '.join(self._digest_checks))
+        parser.add_argument('--sample', dest='sample_check', choices=list(ENTRY_CHECKS),
+                            help='compare a random sample of the check\'s entries and estimate how many differ')
+        parser.add_argument('--sample-size', type=int, dest='sample_size', default=1000,
+                            help='number of entries sampled (default: %(default)s)')
+        parser.add_argument('--sample-seed', dest='sample_seed', default='0',
+                            help='seed picking the sample, the same seed samples the same entries '
+                                 '(default: %(default)s)')
+        parser.add_argument('--certs', action='store_true', dest='cert_stats',
+                            help='count the certificates of the CA by status and month of expiry and compare them '
+                                 'range by range in a single pass over the certificate repository')
+        parser.add_argument('--cert-ranges', dest='cert_ranges', default='serial', choices=['serial', 'issued'],
+                            help='compare the certificates per range of serial numbers or per month of issue '
+                                 '(default: %(default)s)')
+        parser.add_argument('--cert-range-size', type=int, dest='cert_range_size', default=10000,
+                            help='number of serial numbers per range (default: %(default)s)')
+        parser.add_argument('--cert-months', type=int, dest='cert_months', default=12,
+                            help='number of months of expiring certificates listed (default: %(default)s)')
         parser.add_argument('-w', '--warning', type=int, dest='warning',
                             default=1, help='number of failed checks before warning (default: %(default)s)')
         parser.add_argument('-c', '--critical', type=int, dest='critical',
                             default=2, help='number of failed checks before critical (default: %(default)s)')
+        parser.add_argument('--lag-warning', type=int, dest='lag_warning', default=60,
+                            help='seconds of replication lag before the lag check fails with a warning '
+                                 '(default: %(default)s)')
+        parser.add_argument('--lag-critical', type=int, dest='lag_critical', default=300,
+                            help='seconds of replication lag before the lag check is critical (default: %(default)s)')
 
         args = parser.parse_args()
 
@@ -169,6 +444,26 @@ class Main(object):
         elif not args.log_file:
             args.log_file = self._app_name + '.log'
 
+        if args.state_file == 'not_set':
+            args.state_file = None
+        elif not args.state_file:
+            args.state_file = self._default_path('state')
+
+        if args.socket == 'not_set':
+            args.socket = None
+        elif not args.socket:
+            args.socket = self._default_path('sock')
+
+        if args.profile == 'not_set':
+            args.profile = None
+        elif not args.profile:
+            args.profile = ''
+
+        if args.exporter == 'not_set':
+            args.exporter = None
+        elif not args.exporter:
+            args.exporter = ':9479'
+
         if args.nagios_check == 'not_set':
             args.nagios_check = None
         elif not args.nagios_check:
@@ -208,57 +503,581 @@ class Main(object):
             return
 
         config.read(config_file)
+        self._realm_names = [section.split(':', 1)[1] for section in config.sections() if section.startswith('IPA:')]
 
-        if not config.has_section('IPA'):
-            self._log.debug('Config file has no IPA section')
-            return
+        # a realm's options default to those of the IPA section, apart from its domain and servers
+        for section in ['IPA'] if self._realm is None else ['IPA', 'IPA:%s' % self._realm]:
+            if not config.has_section(section):
+                self._log.debug('Config file has no %s section' % section)
+                continue
+            if section != 'IPA':
+                self._domain, self._hosts = self._realm, []
+            self._load_section(config, section)
 
-        if config.has_option('IPA', 'DOMAIN'):
-            self._domain = config.get('IPA', 'DOMAIN')
+    def _load_section(self, config, section):
+        if config.has_option(section, 'DOMAIN'):
+            self._domain = config.get(section, 'DOMAIN')
             self._log.debug('DOMAIN = %s' % self._domain)
         else:
-            self._log.debug('IPA.DOMAIN not set')
+            self._log.debug('%s.DOMAIN not set' % section)
 
-        if config.has_option('IPA', 'HOSTS'):
-            self._hosts = config.get('IPA', 'HOSTS')
+        if config.has_option(section, 'HOSTS'):
+            self._hosts = config.get(section, 'HOSTS')
             self._log.debug('HOSTS = %s' % self._hosts)
             self._hosts = self._hosts.replace(',', ' ').split()
         else:
-            self._log.debug('IPA.SERVERS not set')
+            self._log.debug('%s.SERVERS not set' % section)
 
-        if config.has_option('IPA', 'BINDDN'):
-            self._binddn = config.get('IPA', 'BINDDN')
+        if config.has_option(section, 'BINDDN'):
+            self._binddn = config.get(section, 'BINDDN')
             self._log.debug('BINDDN = %s' % self._binddn)
         else:
-            self._log.debug('IPA.BINDDN not set')
+            self._log.debug('%s.BINDDN not set' % section)
 
-        if config.has_option('IPA', 'BINDPW'):
-            self._bindpw = config.get('IPA', 'BINDPW')
+        if config.has_option(section, 'BINDPW'):
+            self._bindpw = config.get(section, 'BINDPW')
             self._log.debug('BINDPW = ********')
         else:
-            self._log.debug('IPA.BINDPW not set')
+            self._log.debug('%s.BINDPW not set' % section)
+
+        if config.has_option(section, 'THREADS'):
+            self._threads = config.getint(section, 'THREADS')
+            self._log.debug('THREADS = %s' % self._threads)
+        else:
+            self._log.debug('%s.THREADS not set' % section)
+
+        if config.has_option(section, 'PAGE_SIZE'):
+            self._page_size = config.getint(section, 'PAGE_SIZE')
+            self._log.debug('PAGE_SIZE = %s' % self._page_size)
+        else:
+            self._log.debug('%s.PAGE_SIZE not set' % section)
+
+        if config.has_option(section, 'STATE_FILE'):
+            self._state_file = os.path.expanduser(config.get(section, 'STATE_FILE'))
+            self._log.debug('STATE_FILE = %s' % self._state_file)
+        else:
+            self._log.debug('%s.STATE_FILE not set' % section)
+
+        if config.has_option(section, 'RESYNC'):
+            self._resync = config.getint(section, 'RESYNC')
+            self._log.debug('RESYNC = %s' % self._resync)
+        else:
+            self._log.debug('%s.RESYNC not set' % section)
+
+        if config.has_option(section, 'SOCKET'):
+            self._socket = os.path.expanduser(config.get(section, 'SOCKET'))
+            self._log.debug('SOCKET = %s' % self._socket)
+        else:
+            self._log.debug('%s.SOCKET not set' % section)
+
+        if config.has_option(section, 'INTERVAL'):
+            self._interval = config.getint(section, 'INTERVAL')
+            self._log.debug('INTERVAL = %s' % self._interval)
+        else:
+            self._log.debug('%s.INTERVAL not set' % section)
+
+        if config.has_option(section, 'DEADLINE'):
+            self._deadline = self._seconds(config.get(section, 'DEADLINE'))
+            self._log.debug('DEADLINE = %s' % self._deadline)
+        else:
+            self._log.debug('%s.DEADLINE not set' % section)
+
+        if config.has_option(section, 'CACHE_FILE'):
+            self._cache_file = os.path.expanduser(config.get(section, 'CACHE_FILE'))
+            self._log.debug('CACHE_FILE = %s' % self._cache_file)
+        else:
+            self._log.debug('%s.CACHE_FILE not set' % section)
+
+        if config.has_option(section, 'CACHE_TTL'):
+            self._cache_ttl = config.getint(section, 'CACHE_TTL')
+            self._log.debug('CACHE_TTL = %s' % self._cache_ttl)
+        else:
+            self._log.debug('%s.CACHE_TTL not set' % section)
+
+        if config.has_option(section, 'MAX_LOAD'):
+            self._max_load = config.getfloat(section, 'MAX_LOAD')
+            self._log.debug('MAX_LOAD = %s' % self._max_load)
+        else:
+            self._log.debug('%s.MAX_LOAD not set' % section)
+
+        if config.has_option(section, 'WORKERS'):
+            self._workers = config.getint(section, 'WORKERS')
+            self._log.debug('WORKERS = %s' % self._workers)
+        else:
+            self._log.debug('%s.WORKERS not set' % section)
+
+        if config.has_option(section, 'CONCURRENCY'):
+            self._concurrency = config.get(section, 'CONCURRENCY')
+            self._log.debug('CONCURRENCY = %s' % self._concurrency)
+            self._concurrency = self._concurrency.replace(',', ' ').split()
+        else:
+            self._log.debug('%s.CONCURRENCY not set' % section)
+
+    def _required_checks(self):
+        if self._args.diff_check or self._args.digest_checks is not None or self._args.sample_check or \
+                self._args.cert_stats:
+            return []
+        if self._args.nagios_check and self._args.nagios_check != 'all' and not self._cache:
+            return [self._args.nagios_check]
+        return list(self._checks)
+
+    def _probe_deadline(self):
+        # entries are compared without a deadline, daemon refreshes each get one of their own; with more servers
+        # than threads, each server gets its share of the deadline from the start of its probe so that a slow one
+        # does not use up the time of the servers waiting for a thread
+        if self._deadline is None or self._args.diff_check or self._args.digest_checks is not None or \
+                self._args.sample_check or self._args.cert_stats:
+            return None
+        share = self._deadline * min(self._threads, len(self._hosts)) / float(len(self._hosts))
+        return min(self._start + self._deadline, time.time() + share)
+
+    def _dns_records(self):
+        # DNS names the checks look up
+        return [MSDCS_RECORD % self._domain] if 'msdcs' in self._required_checks() else []
+
+    def _discover_servers(self):
+        if not self._hosts:
+            self._log.debug('Searching for IPA servers in DNS')
+            # the names the checks need later are resolved meanwhile
+            self._resolver.prefetch(self._dns_records())
+            for answer in self._resolver.srv('_ldap._tcp.%s' % self._domain):
+                self._hosts.append(answer.split(' ')[3].rstrip('.'))
+
+            if not self._hosts:
+                self._log.critical('IPA servers not set, also failed to find any in DNS')
+                exit(1)
+
+        self._log.debug('IPA servers: %s' % ', '.join(self._hosts))
+
+    def _concurrency_for(self, host):
+        # limit given for the server by its name or short name, else the one for all servers
+        for name in (host, host.replace('.%s' % self._domain, ''), ''):
+            if name in self._concurrency_limits:
+                return self._concurrency_limits[name]
+        return None
+
+    def _listener(self, host):
+        # results are streamed as NDJSON while the servers are being probed in CLI mode only
+        if self._args.output != 'ndjson' or self._args.nagios_check or self._args.diff_check or \
+                self._args.digest_checks is not None or self._args.sample_check or self._args.cert_stats:
+            return None
+        return functools.partial(self._emit, host)
+
+    def _write(self, record):
+        # called from the worker threads too, a broken pipe must not escape them
+        root = self._parent or self
+        if root._output_closed:
+            return
+        try:
+            sys.stdout.write(json.dumps(record) + '\n')
+            sys.stdout.flush()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            root._output_closed = True
+            # stdout is flushed again at exit, which would fail the same way
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+    def _emit(self, host, server, check, final=False):
+        # the lag is only known once every server has been probed
+        if check not in self._checks or check == 'lag' and not final:
+            return
+        record = self._record('result')
+        record.update([('server', host), ('name', server.hostname_short), ('check', check),
+                       ('value', getattr(server, check))])
+        for extra in self._extras.get(check, []):
+            record[extra] = getattr(server, extra, None)
+        with self._emit_lock:
+            if (host, check) in self._emitted:
+                return
+            self._emitted.add((host, check))
+            self._write(record)
+
+    def _probe_server(self, host):
+        # SystemExit raised in a worker thread would kill the thread and leave the pool waiting forever,
+        # hand it back to the main thread instead
+        try:
+            checks = self._required_checks()
+            server = self._servers.get(host)
+            if server is not None and server.connected:
+                # keep the established connection, only the results are computed again
+                server.reset(deadline=self._probe_deadline())
+            else:
+                from .freeipaserver import FreeIPAServer
+                server = FreeIPAServer(host, self._domain, self._binddn, self._bindpw, page_size=self._page_size,
+                                       profile=self._args.profile is not None, deadline=self._probe_deadline(),
+                                       checks=checks, resolver=self._resolver, max_load=self._max_load,
+                                       concurrency=self._concurrency_for(host), listener=self._listener(host))
+            if self._args.syncrepl:
+                # (re)starts the sessions ahead of the checks, which wait for their first refresh
+                server.persist(checks)
+            elif self._state:
+                checks = self._sync_counts(host, server, checks)
+            server.fetch(checks)
+        except SystemExit as e:
+            return e
+        return server
+
+    def _sync_index(self, host, server, check):
+        from .state import sync
+        record = sync(server, check, self._state.get(host, check), self._resync)
+        if record is False:
+            return False
+        self._state.set(host, check, record)
+        return record['index']
+
+    def _sync_counts(self, host, server, checks):
+        # checks counting entries one by one are counted from their synced index, returns the remaining checks
+        from .freeipaserver import DeadlineExceeded
+        remaining = []
+        for check in checks:
+            index = False
+            if check in ENTRY_CHECKS and server.counts_entries(check):
+                try:
+                    index = self._sync_index(host, server, check)
+                except DeadlineExceeded:
+                    # left to the check itself, which reports the timeout
+                    pass
+            if index is False:
+                remaining.append(check)
+            else:
+                setattr(server, check, len(index))
+        return remaining
+
+    def _map(self, func, items):
+        threads = min(self._threads, len(items))
+        if self._parent is not None:
+            return self._map_shared(func, items, threads)
+        from multiprocessing.pool import ThreadPool
+        self._log.debug('Running %s tasks using %s threads' % (len(items), threads))
+        pool = ThreadPool(threads)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _map_shared(self, func, items, threads):
+        # a realm runs its tasks on the pool shared by all the realms, at most threads of them at once
+        self._log.debug('Realm %s: running %s tasks on up to %s shared threads' % (self._realm, len(items), threads))
+        slots = threading.BoundedSemaphore(threads)
+
+        def run(item):
+            try:
+                return func(item)
+            finally:
+                slots.release()
+
+        results = []
+        for item in items:
+            slots.acquire()
+            results.append(self._parent._pool.apply_async(run, (item,)))
+        return [result.get() for result in results]
+
+    def _probe_servers(self):
+        self._resolver.prefetch(self._dns_records())
+        results = self._map(self._probe_server, self._hosts)
+
+        servers = OrderedDict()
+        for host, server in zip(self._hosts, results):
+            if isinstance(server, SystemExit):
+                raise server
+            servers[host] = server
+        if 'lag' in self._required_checks():
+            self._measure_lag(list(servers.values()))
+        if 'replicas' in self._required_checks():
+            self._topology = self._map_topology(servers)
+        return servers
+
+    @staticmethod
+    def _replica_host(url):
+        return url.split('://')[-1].rsplit(':', 1)[0].lower()
+
+    def _replica_name(self, url, rid):
+        if not url:
+            return 'replica %s' % rid
+        return self._replica_host(url).replace('.%s' % self._domain.lower(), '')
+
+    @staticmethod
+    def _live_replicas(servers):
+        # the servers and the replicas they have agreements with, None if no agreements could be read
+        live, known = set(), False
+        for server in servers:
+            if not server.connected:
+                continue
+            live.add(server.fqdn.lower())
+            if isinstance(server.agreements, list):
+                known = True
+                live.update(fqdn.lower() for fqdn, status in server.agreements)
+        return live if known else None
+
+    def _measure_lag(self, servers):
+        # every server's lag behind the most advanced one for the changes made on each replica, from the last CSNs
+        # in their replica update vectors; the lag check reports the largest
+        # the RUVs keep the replica IDs of decommissioned replicas, whose last changes would count as lag forever
+        live = self._live_replicas(servers)
+        urls, first, last = {}, {}, {}
+        for server in servers:
+            if server.lag == TIMED_OUT or not server.ruv:
+                continue
+            for rid, (url, first_csn, last_csn) in server.ruv.items():
+                if live is not None and url and self._replica_host(url) not in live:
+                    self._log.debug('%s: skipping replica %s (%s), no agreement with it' %
+                                    (server.hostname_short, rid, url))
+                    continue
+                urls.setdefault(rid, url)
+                if last_csn:
+                    first[rid] = min(first.get(rid, csn_time(first_csn)), csn_time(first_csn))
+                    last[rid] = max(last.get(rid, 0), csn_time(last_csn))
+
+        for server in servers:
+            server.replica_lag = {}
+            if server.lag == TIMED_OUT or not server.ruv:
+                continue
+            for rid, newest in last.items():
+                url, first_csn, last_csn = server.ruv.get(rid, (None, None, None))
+                # a server that has seen none of the replica's changes is behind since its first one
+                seen = csn_time(last_csn) if last_csn else first[rid]
+                server.replica_lag[self._replica_name(urls[rid], rid)] = newest - seen
+            server.lag = max(server.replica_lag.values()) if server.replica_lag else 0
+            self._log.debug('%s: replication lag %s' % (server.hostname_short, server.replica_lag))
+
+    def _map_topology(self, servers):
+        # merges the agreements of all servers into the replication graph defined by the topology segments, which
+        # every server holds a copy of so they are read from the first that answers
+        from .topology import Topology
+        segments = False
+        for server in servers.values():
+            segments = server.topology()
+            if segments is not False:
+                break
+        if segments is False:
+            self._log.debug('Failed to read the replication topology')
+            return None
+        topology = Topology(segments)
+        for host, server in servers.items():
+            name = server.connected and server.fqdn or (host if '.' in host else '%s.%s' % (host, self._domain))
+            topology.add(name, server.agreements, server.connected)
+        report = topology.report()
+        self._log.debug('Replication topology: %s' % report)
+        return report
+
+    def _topology_problems(self):
+        from .topology import problems
+        if not self._topology:
+            return []
+        return problems(self._topology, short=lambda name: name.replace('.%s' % self._domain, ''))
 
     def run(self):
+        try:
+            self._run()
+            if self._output_closed:
+                self._log.debug('Output closed by its reader')
+                exit(0)
+        finally:
+            if self._state:
+                self._state.close()
+            if self._args.profile is not None:
+                self._print_profile()
+
+    def _run(self):
         self._log.debug('Starting...')
-        if self._args.nagios_check:
+        if self._args.realms is not None:
+            self._log.debug('Realm mode')
+            self._run_realms()
+        elif self._args.daemon:
+            self._log.debug('Daemon mode')
+            self._serve()
+        elif self._args.exporter:
+            self._log.debug('Exporter mode')
+            self._export()
+        elif self._args.nagios_check:
             self._log.debug('Nagios plugin mode')
             self._nagios_plugin(self._args.nagios_check)
+        elif self._args.diff_check:
+            self._log.debug('Diff mode')
+            self._print_diff(self._args.diff_check)
+        elif self._args.digest_checks is not None:
+            self._log.debug('Digest mode')
+            self._print_digests(self._args.digest_checks or self._digest_checks)
+        elif self._args.sample_check:
+            self._log.debug('Sample mode')
+            self._print_sample(self._args.sample_check)
+        elif self._args.cert_stats:
+            self._log.debug('Certificate mode')
+            self._print_certs()
+        elif self._args.output == 'json':
+            self._log.debug('CLI mode, JSON output')
+            self._print_json()
+        elif self._args.output == 'ndjson':
+            self._log.debug('CLI mode, NDJSON output')
+            self._print_records()
         else:
             self._log.debug('CLI mode')
             self._print_table()
         self._log.debug('Finishing...')
 
+    def _run_realms(self):
+        if self._args.nagios_check:
+            self._nagios_realms(self._args.nagios_check)
+        elif self._args.output == 'json':
+            documents = OrderedDict((name, realm._document() if realm else None)
+                                    for name, realm in self._realms.items())
+            self._write({'time': time.time(), 'duration': self._duration, 'realms': documents})
+        elif self._args.output == 'ndjson':
+            for realm in self._realms.values():
+                if realm is not None:
+                    realm._print_records()
+        else:
+            for name, realm in self._realms.items():
+                if realm is None:
+                    self._log.info('%s: failed to check the realm' % name)
+                    continue
+                self._log.info('%s (%s):' % (name, realm._domain))
+                realm._print_table()
+
+    def _snapshot(self):
+        servers = []
+        for host, server in self._servers.items():
+            results = dict((check, getattr(server, check)) for check in self._checks)
+            results['healthy_agreements'] = server.healthy_agreements
+            results['replica_lag'] = getattr(server, 'replica_lag', {})
+            servers.append({'host': host, 'hostname_short': server.hostname_short, 'results': results})
+        return {'time': time.time(), 'interval': self._interval, 'domain': self._domain, 'hosts': list(self._hosts),
+                'servers': servers, 'topology': self._topology}
+
+    def _refresh(self):
+        start = self._start = time.time()
+        self._resolver.expire()
+        try:
+            self._servers = self._probe_servers()
+        except Exception as e:
+            self._log.error('Refresh failed, serving the previous results (%s)' % e)
+            raise
+        except SystemExit:
+            self._log.error('Refresh failed, serving the previous results')
+            raise
+        self._duration = time.time() - start
+        self._log.debug('Refreshed in %.2f seconds' % self._duration)
+
+    def _check_interval(self):
+        if self._interval < 1:
+            self._log.critical('Incorrect refresh interval: %s' % self._interval)
+            exit(1)
+
+    def _serve(self):
+        self._check_interval()
+        if not self._socket:
+            self._socket = self._default_path('sock')
+        server = unix_server(self._socket)
+
+        def refresh():
+            self._refresh()
+            return encode(self._snapshot())
+
+        self._log.info('Listening on %s, refreshing every %s seconds' % (self._socket, self._interval))
+        Daemon(server, self._interval, refresh, encode(self._snapshot())).serve_forever()
+
+    def _metrics(self, metrics):
+        for server in self._servers.values():
+            for kind, query, seconds, entries, size in server.latencies:
+                metrics.observe(kind, server.hostname_short, query, seconds)
+        consistent = OrderedDict(
+            (check, self._is_consistent(check, [getattr(server, check) for server in self._servers.values()]))
+            for check in self._checks)
+        return metrics.render(self._snapshot(), consistent, self._duration)
+
+    def _export(self):
+        # scrapes are answered from the last probe, they never make cipa search the servers
+        self._check_interval()
+        from .exporter import Metrics, http_server
+        try:
+            server = http_server(self._args.exporter)
+        except (ValueError, socket.error) as e:
+            self._log.critical('Failed to listen on %s (%s)' % (self._args.exporter, e))
+            exit(1)
+        metrics = Metrics()
+
+        def refresh():
+            self._refresh()
+            return self._metrics(metrics)
+
+        self._log.info('Serving metrics on http://%s/metrics, refreshing every %s seconds' %
+                       (self._args.exporter, self._interval))
+        Daemon(server, self._interval, refresh, self._metrics(metrics)).serve_forever()
+
+    def _query_daemon(self):
+        snapshot = query(self._socket)
+        if not snapshot:
+            self._log.debug('No daemon listening on %s, probing servers directly' % self._socket)
+            return None
+        age = time.time() - snapshot['time']
+        if age > 3 * snapshot['interval']:
+            self._log.debug('Daemon results are %d seconds old, probing servers directly' % age)
+            return None
+        # the daemon may be checking another domain or other servers than the ones asked for
+        domain = self._args.domain or self._domain
+        hosts = self._args.hosts or self._hosts
+        if domain and (snapshot.get('domain') or '').lower() != domain.lower() or \
+                hosts and set(h.lower() for h in hosts) != set(h.lower() for h in snapshot.get('hosts', [])):
+            self._log.debug('Daemon results are for %s (%s), probing servers directly' %
+                            (snapshot.get('domain'), ', '.join(snapshot.get('hosts', []))))
+            return None
+        self._log.debug('Using daemon results from %d seconds ago' % age)
+        return self._snapshot_servers(snapshot)
+
+    def _snapshot_servers(self, snapshot):
+        self._topology = snapshot.get('topology')
+        return OrderedDict((server['host'], ServerSnapshot(server['hostname_short'], server['results']))
+                           for server in snapshot['servers'])
+
+    def _result_cache(self):
+        cache_dir = os.path.dirname(os.path.abspath(self._cache_file))
+        if not os.path.exists(cache_dir):
+            self._log.debug('Cache directory %s does not exist, creating' % cache_dir)
+            os.makedirs(cache_dir)
+        return ResultCache(self._cache_file, self._cache_ttl)
+
+    def _cached_servers(self):
+        if self._shared_cache is not None:
+            return self._cached_probe(self._shared_cache)
+        with self._result_cache() as cache:
+            return self._cached_probe(cache)
+
+    def _cached_probe(self, cache):
+        cached = cache.get(self._dns_cache_key) or {'answers': {}}
+        self._resolver.load(cached['answers'])
+        self._discover_servers()
+        answers = self._resolver.dump()
+        if answers and answers != cached['answers']:
+            # kept until the first of them expires
+            cache.set(self._dns_cache_key, {'time': time.time(), 'expires': min(a[0] for a in answers.values()),
+                                            'answers': answers})
+
+        key = '%s %s %s' % (self._domain, self._binddn, ' '.join(self._hosts))
+        snapshot = cache.get(key)
+        if snapshot:
+            self._log.debug('Using cached results from %d seconds ago' % (time.time() - snapshot['time']))
+            return self._snapshot_servers(snapshot)
+        self._servers = self._probe_servers()
+        snapshot = self._snapshot()
+        # partial results are not worth sharing, the next check may have better luck
+        if not any(value in (TIMED_OUT, POSTPONED) for server in snapshot['servers']
+                   for value in server['results'].values()):
+            cache.set(key, snapshot)
+        return self._servers
+
+    def _table(self, fields):
+        from prettytable import PrettyTable
+        return PrettyTable(fields, header=not self._args.disable_header, border=not self._args.disable_border)
+
     def _print_table(self):
-        table = PrettyTable(
-            ['FreeIPA servers:'] + [getattr(server, 'hostname_short') for server in self._servers.values()] + ['STATE'],
-            header=not self._args.disable_header,
-            border=not self._args.disable_border
-        )
+        table = self._table(
+            ['FreeIPA servers:'] + [getattr(server, 'hostname_short') for server in self._servers.values()] + ['STATE'])
         table.align = 'l'
 
         for check in self._checks:
-            state = 'OK' if self._is_consistent(check, [getattr(server, check) for server in self._servers.values()])\
-                else 'FAIL'
+            state = self._check_state(check)
             table.add_row(
                 [self._checks[check]] +
                 [getattr(server, check) for server in self._servers.values()] +
@@ -266,41 +1085,358 @@ class Main(object):
             )
 
         self._log.info(table)
+        if self._topology_problems():
+            self._log.info('Topology: %s' % '; '.join(self._topology_problems()))
+
+    def _check_states(self):
+        return OrderedDict((check, OrderedDict([('title', title), ('state', self._check_state(check))]))
+                           for check, title in self._checks.items())
+
+    def _document(self):
+        snapshot = self._snapshot()
+        snapshot['duration'] = self._duration
+        snapshot['checks'] = self._check_states()
+        return snapshot
+
+    def _print_json(self):
+        self._write(self._document())
+
+    def _record(self, kind):
+        # NDJSON record of the kind, naming the realm in realm mode
+        return OrderedDict([('type', kind)] + ([('realm', self._realm)] if self._realm else []))
+
+    def _print_records(self):
+        # results not streamed while probing (the lag, counts synced from the state file, results from the daemon or
+        # the cache) are written now, followed by the replication topology and the state of every check
+        for host, server in self._servers.items():
+            for check in self._checks:
+                self._emit(host, server, check, final=True)
+        if self._topology:
+            record = self._record('topology')
+            record.update(self._topology)
+            with self._emit_lock:
+                self._write(record)
+        for check, state in self._check_states().items():
+            record = self._record('check')
+            record['check'] = check
+            record.update(state)
+            with self._emit_lock:
+                self._write(record)
+
+    def _print_profile(self):
+        rows = []
+        for host, server in self._servers.items():
+            for check, record in server.profile.items():
+                row = {'server': server.hostname_short, 'check': check}
+                row.update(record)
+                rows.append(row)
+        rows.sort(key=lambda row: row['time'], reverse=True)
+
+        table = self._table(['Server', 'Check', 'Time (s)', 'Queries', 'Entries', 'Bytes'])
+        table.align = 'r'
+        table.align['Server'] = table.align['Check'] = 'l'
+        for row in rows:
+            check = self._checks.get(row['check'], row['check'].capitalize())
+            table.add_row([row['server'], check, '%.3f' % row['time'], row['queries'], row['entries'], row['bytes']])
+        self._log.info(table)
+        self._log.info('Probed %s servers in %.3f seconds' % (len(self._servers), self._duration))
+
+        if self._args.profile:
+            self._log.debug('Writing profile to %s' % self._args.profile)
+            with open(self._args.profile, 'w') as profile:
+                json.dump({'duration': self._duration, 'checks': rows}, profile, indent=2)
+
+    def _scan_servers(self, check, func):
+        # runs func(host, server) on every server in parallel, skips servers that failed
+        results = self._map(lambda item: func(*item), list(self._servers.items()))
+        servers = []
+        for server, result in zip(self._servers.values(), results):
+            if result is False:
+                self._log.warning('%s: failed to scan %s, skipping' % (server.hostname_short, self._checks[check]))
+                continue
+            servers.append(server)
+
+        if len(servers) < 2:
+            self._log.critical('At least two IPA servers need to be available to compare entries')
+            exit(1)
+        return servers, [result for result in results if result is not False]
+
+    def _print_entries(self, check, servers, resolvers, keys):
+        dns = {}
+        for resolver in resolvers:
+            dns.update((key, dn) for key, dn in resolver.dns.items() if key in keys)
+
+        table = self._table([self._checks[check] + ':'] + [server.hostname_short for server in servers] + ['STATE'])
+        table.align = 'l'
+
+        for key in sorted(dns, key=lambda k: dns[k].lower()):
+            states = [resolver.states.get(key) for resolver in resolvers]
+            table.add_row(
+                [dns[key]] +
+                [state if state is not None else 'MISSING' for state in states] +
+                ['MISSING' if None in states else 'STALE']
+            )
+
+        self._log.info(table)
+
+    def _print_diff(self, check):
+        from .diff import EntryIndex, EntryResolver, compare, INDEX_ATTRS
+        # first pass: compact index of DN and state digests from every server
+        if self._state:
+            servers, indexes = self._scan_servers(check, lambda host, server: self._sync_index(host, server, check))
+        else:
+            servers, indexes = self._scan_servers(
+                check,
+                lambda host, server: server.scan(check, EntryIndex().build, INDEX_ATTRS)
+            )
+        for server, index in zip(servers, indexes):
+            self._log.debug('%s: %s entries indexed' % (server.hostname_short, len(index)))
+
+        differences = compare(indexes)
+        self._log.debug('%s entries differ' % len(differences))
+
+        if not differences:
+            self._log.info('No differences found in %s' % self._checks[check])
+            return
+
+        # second pass: DNs and state of the entries that differ only
+        resolvers = self._map(
+            lambda server: server.scan(check, EntryResolver(differences.__contains__).resolve, INDEX_ATTRS),
+            servers
+        )
+        self._print_entries(check, servers, resolvers, differences)
+
+    def _print_digests(self, checks):
+        from .diff import DigestTree, EntryResolver, bucket, compare_resolved, compare_trees, INDEX_ATTRS
+        table = self._table(
+            ['FreeIPA servers:'] + [server.hostname_short for server in self._servers.values()] + ['STATE'])
+        table.align = 'l'
+        drill = []
+
+        for check in checks:
+            if self._state:
+                servers, indexes = self._scan_servers(check, lambda host, server: self._sync_index(host, server, check))
+                trees = [index.tree() for index in indexes]
+            else:
+                # the DNs are kept along, the entries of the buckets that differ need not be searched again
+                servers, trees = self._scan_servers(
+                    check,
+                    lambda host, server: server.scan(check, DigestTree(keep=True).build, INDEX_ATTRS)
+                )
+            roots = dict((server.hostname_short, '%016x' % tree.root) for server, tree in zip(servers, trees))
+            buckets, rounds = compare_trees(trees)
+            self._log.debug('%s: %s buckets differ after comparing %s levels' %
+                            (self._checks[check], len(buckets), rounds))
+            table.add_row(
+                [self._checks[check]] +
+                [roots.get(server.hostname_short) for server in self._servers.values()] +
+                ['FAIL' if buckets else 'OK']
+            )
+            if buckets:
+                # the trees are dropped once the entries of the buckets that differ are taken from them
+                drill.append((check, servers, buckets, [tree.resolve(buckets) for tree in trees]))
+
+        self._log.info(table)
+
+        # only the entries that fall into the buckets that differ are resolved, searching the servers again for
+        # them when the trees were built from the indexes of the state file, which keep no DNs
+        for check, servers, buckets, resolvers in drill:
+            if None in resolvers:
+                resolvers = self._map(
+                    lambda server: server.scan(check, EntryResolver(lambda key: bucket(key) in buckets).resolve,
+                                               INDEX_ATTRS),
+                    servers
+                )
+            self._print_entries(check, servers, resolvers, compare_resolved(resolvers))
+
+    def _print_sample(self, check):
+        from .sample import Sampler, SAMPLE_ATTRS, content_digest, interval
+        if self._args.sample_size < 1:
+            self._log.critical('Incorrect sample size: %s' % self._args.sample_size)
+            exit(1)
+
+        # the sample is picked from the DNs of the first server available, then read on every server
+        sampler = False
+        for reference in self._servers.values():
+            sampler = reference.scan(check, Sampler(self._args.sample_size, self._args.sample_seed).sample)
+            if sampler is not False:
+                break
+        if sampler is False:
+            self._log.critical('Failed to sample %s on any of the servers' % self._checks[check])
+            exit(1)
+        dns = sampler.dns
+        self._log.debug('%s: sampled %s of %s entries' % (reference.hostname_short, len(dns), sampler.count))
+        if not dns:
+            self._log.info('No entries to sample in %s on %s' % (self._checks[check], reference.hostname_short))
+            return
+
+        servers, reads = self._scan_servers(check, lambda host, server: server.read(check, dns, SAMPLE_ATTRS))
+        digests = [dict((dn, content_digest(attrs)) for dn, attrs in read.items()) for read in reads]
+        expected = digests[servers.index(reference)] if reference in servers else digests[0]
+
+        table = self._table(['Server', 'Sampled', 'Missing', 'Differ', 'Divergence', '95% CI'])
+        table.align = 'r'
+        table.align['Server'] = 'l'
+
+        def add_row(name, missing, differ):
+            low, high = interval(missing + differ, len(dns), sampler.count)
+            table.add_row([name, len(dns), missing, differ, '%.2f%%' % (100.0 * (missing + differ) / len(dns)),
+                           '%.2f%% - %.2f%%' % (100 * low, 100 * high)])
+
+        keys = [normalize_dn(dn) for dn in dns]
+        for server, found in zip(servers, digests):
+            missing = sum(1 for key in keys if key not in found)
+            differ = sum(1 for key in keys if key in found and key in expected and found[key] != expected[key])
+            add_row(server.hostname_short, missing, differ)
+        # an entry diverges when it is missing from or differs on any of the servers
+        divergent = [dn for dn, key in zip(dns, keys) if len(set(found.get(key) for found in digests)) > 1]
+        missing = sum(1 for key in keys if any(key not in found for found in digests))
+        add_row('ALL', missing, len(divergent) - missing)
+
+        self._log.info('%s: %s of %s entries sampled from %s (seed %s)' %
+                       (self._checks[check], len(dns), sampler.count, reference.hostname_short,
+                        self._args.sample_seed))
+        self._log.info(table)
+        for dn in divergent:
+            self._log.info('Divergent: %s' % dn)
+
+    def _print_certs(self):
+        from .certs import CERT_ATTRS, VALID, CertResolver, CertStats, compare_ranges, months, range_filter, \
+            range_label, serial
+        by, size = self._args.cert_ranges, self._args.cert_range_size
+        if size < 1 or self._args.cert_months < 0:
+            self._log.critical('Incorrect certificate range size or number of months')
+            exit(1)
+
+        # a single pass over every server's repository counts everything reported
+        servers, stats = self._scan_servers(
+            'certs', lambda host, server: server.scan('certs', CertStats(by, size).build, CERT_ATTRS))
+        table = self._table(['Certificates:'] + [server.hostname_short for server in servers] + ['STATE'])
+        table.align = 'l'
+
+        def add_row(name, counts):
+            table.add_row([name] + counts + ['OK' if counts.count(counts[0]) == len(counts) else 'FAIL'])
+
+        add_row('Total', [stat.count for stat in stats])
+        totals = [stat.statuses() for stat in stats]
+        for status in sorted(set(status for total in totals for status in total)):
+            add_row(status.capitalize(), [total.get(status, 0) for total in totals])
+        now = time.strftime('%Y-%m', time.gmtime())
+        add_row('%s, expired' % VALID.capitalize(), [stat.expired(now) for stat in stats])
+        for expires in months(now, self._args.cert_months):
+            add_row('%s, expiring %s' % (VALID.capitalize(), expires), [stat.expiring(expires) for stat in stats])
+        self._log.info(table)
+
+        keys = compare_ranges(stats)
+        ranges = len(set(key for stat in stats for key in stat.ranges))
+        self._log.info('%s of %s ranges of certificates differ' % (len(keys), ranges))
+        if not keys:
+            return
+
+        table = self._table(['Ranges:'] + [server.hostname_short for server in servers])
+        table.align = 'l'
+        for key in keys:
+            table.add_row([range_label(key, by, size)] + [stat.ranges.get(key, (0, 0))[0] for stat in stats])
+        self._log.info(table)
+
+        # second pass: only the certificates in the ranges that differ are searched for and listed
+        fltr = range_filter(keys, by, size)
+        resolvers = self._map(
+            lambda server: server.scan('certs', CertResolver(keys, by, size).resolve, CERT_ATTRS, fltr=fltr), servers)
+        resolvers = [resolver.statuses if resolver is not False else {} for resolver in resolvers]
+        dns = set(dn for statuses in resolvers for dn in statuses)
+        table = self._table(['Certificate:'] + [server.hostname_short for server in servers] + ['STATE'])
+        table.align = 'l'
+        for dn in sorted(dns, key=lambda dn: (serial(dn) is None, serial(dn), dn.lower())):
+            statuses = [statuses.get(dn) for statuses in resolvers]
+            if statuses.count(statuses[0]) == len(statuses):
+                continue
+            table.add_row(
+                [serial(dn) if serial(dn) is not None else dn] +
+                [status if status is not None else 'MISSING' for status in statuses] +
+                ['MISSING' if None in statuses else 'STATUS']
+            )
+        self._log.info(table)
 
     def _is_consistent(self, check, check_results):
+        # values that timed out or were postponed are left out, the check is judged on the ones collected
+        servers = [server for server in self._servers.values() if getattr(server, check) not in (TIMED_OUT, POSTPONED)]
+        check_results = [result for result in check_results if result not in (TIMED_OUT, POSTPONED)]
+        if not check_results:
+            return False
         if check == 'conflicts':
-            conflicts = [getattr(server, 'conflicts') for server in self._servers.values()]
+            conflicts = [getattr(server, 'conflicts') for server in servers]
             if conflicts.count(conflicts[0]) == len(conflicts) and conflicts[0] == 0:
                 return True
             else:
                 return False
         elif check == 'ghosts':
-            ghosts = [getattr(server, 'ghosts') for server in self._servers.values()]
+            ghosts = [getattr(server, 'ghosts') for server in servers]
             if ghosts.count(ghosts[0]) == len(ghosts) and ghosts[0] == 0:
                 return True
             else:
                 return False
         elif check == 'replicas':
-            healths = [getattr(server, 'healthy_agreements') for server in self._servers.values()]
+            healths = [getattr(server, 'healthy_agreements') for server in servers]
+            if self._topology and (self._topology['broken'] or len(self._topology['partitions']) > 1):
+                return False
             if healths.count(healths[0]) == len(healths) and healths[0]:
                 return True
             else:
                 return False
+        elif check == 'lag':
+            return None not in check_results and max(check_results) < self._args.lag_warning
         if check_results.count(check_results[0]) == len(check_results) and None not in check_results:
             return True
         else:
             return False
 
+    def _check_state(self, check):
+        # OK, FAIL, or TIMEOUT (BUSY) when the values collected agree but some timed out (were postponed)
+        results = [getattr(server, check) for server in self._servers.values()]
+        missing = set([TIMED_OUT, POSTPONED]) & set(results)
+        if missing and (self._is_consistent(check, results) or missing.issuperset(results)):
+            return 'TIMEOUT' if TIMED_OUT in missing else 'BUSY'
+        return 'OK' if self._is_consistent(check, results) else 'FAIL'
+
     def _nagios_plugin(self, check):
         self._log.debug('Running check: %s' % check)
+        msg, code, text = self._nagios_result(check)
+        self._log.info('%s - %s' % (msg, text))
+        exit(code)
+
+    def _nagios_realms(self, check):
+        # the first line sums the realms up, a line per realm follows; the worst state is the plugin's
+        self._log.debug('Running check: %s' % check)
+        severity = [0, 3, 1, 2]
+        codes, lines = [], []
+        for name, realm in self._realms.items():
+            if realm is None:
+                msg, code, text = 'UNKNOWN', 3, 'failed to check the realm'
+            else:
+                self._log.debug('Realm %s' % name)
+                msg, code, text = realm._nagios_result(check)
+            codes.append(code)
+            lines.append('%s: %s - %s' % (name, msg, text))
+        code = max(codes, key=severity.index)
+        msg = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN'][code]
+        self._log.info('%s - %s/%s realms OK\n%s' % (msg, codes.count(0), len(codes), '\n'.join(lines)))
+        exit(code)
+
+    def _nagios_result(self, check):
+        # plugin state, exit code and text of the check
         if check == 'all':
             checks_no = len(self._checks)
-            oks = 0
-            for check in self._checks:
-                if self._is_consistent(check, [getattr(server, check) for server in self._servers.values()]):
-                    oks += 1
-            fails = checks_no - oks
-            if 0 <= fails < self._args.warning:
+            states = [self._check_state(check) for check in self._checks]
+            oks = states.count('OK')
+            timeouts = states.count('TIMEOUT')
+            postponed = states.count('BUSY')
+            fails = states.count('FAIL')
+            if 0 <= fails < self._args.warning and (timeouts or postponed):
+                # failures so far are below the thresholds but the missing values could change that
+                msg = 'UNKNOWN'
+                code = 3
+            elif 0 <= fails < self._args.warning:
                 msg = 'OK'
                 code = 0
             elif self._args.warning <= fails < self._args.critical:
@@ -312,17 +1448,62 @@ class Main(object):
             else:
                 msg = 'UNKNOWN'
                 code = 3
-            self._log.info('%s - %s/%s checks passed' % (msg, oks, checks_no))
-            exit(code)
+            missing = ''
+            if timeouts:
+                missing += ', %s timed out on %s' % (timeouts, self._missing_on(TIMED_OUT))
+            if postponed:
+                missing += ', %s postponed on busy %s' % (postponed, self._missing_on(POSTPONED))
+            return msg, code, '%s/%s checks passed%s' % (oks, checks_no, missing)
         else:
-            if self._is_consistent(check, [getattr(server, check) for server in self._servers.values()]):
+            state = self._check_state(check)
+            name = self._checks[check]
+            if state == 'OK':
                 msg = 'OK'
                 code = 0
+            elif state == 'TIMEOUT':
+                msg = 'UNKNOWN'
+                code = 3
+                name = '%s timed out on %s' % (name, ', '.join(
+                    server.hostname_short for server in self._servers.values() if getattr(server, check) == TIMED_OUT))
+            elif state == 'BUSY':
+                msg = 'UNKNOWN'
+                code = 3
+                name = '%s postponed on busy %s' % (name, ', '.join(
+                    server.hostname_short for server in self._servers.values() if getattr(server, check) == POSTPONED))
+            elif check == 'lag':
+                msg, code, name = self._lag_alert(name)
+            elif check == 'replicas' and self._topology_problems():
+                msg = 'CRITICAL'
+                code = 2
+                name = '%s: %s' % (name, '; '.join(self._topology_problems()))
             else:
                 msg = 'CRITICAL'
                 code = 2
-            self._log.info('%s - %s' % (msg, self._checks[check]))
-            exit(code)
+            return msg, code, name
+
+    def _missing_on(self, missing):
+        # servers missing values of the checks whose other values agree
+        names = []
+        for check in self._checks:
+            if self._check_state(check) in ('TIMEOUT', 'BUSY'):
+                names.extend(server.hostname_short for server in self._servers.values()
+                             if getattr(server, check) == missing and server.hostname_short not in names)
+        return ', '.join(names)
+
+    def _lag_alert(self, name):
+        # WARNING or CRITICAL depending on the largest lag, naming the pairs of servers and replicas lagging behind
+        servers = [server for server in self._servers.values() if server.lag != TIMED_OUT]
+        lags = [server.lag for server in servers]
+        if None in lags:
+            return 'CRITICAL', 2, '%s unknown on %s' % (name, ', '.join(
+                server.hostname_short for server in servers if server.lag is None))
+        pairs = ['%s %ss behind %s' % (server.hostname_short, seconds, replica)
+                 for server in servers for replica, seconds in sorted(getattr(server, 'replica_lag', {}).items())
+                 if seconds >= self._args.lag_warning]
+        name = '%s: %s' % (name, ', '.join(pairs))
+        if max(lags) < self._args.lag_critical:
+            return 'WARNING', 1, name
+        return 'CRITICAL', 2, name
 
 
 def main():
@@ -0,0 +1,124 @@
+#  -*- coding: utf-8 -*-
+"""
+DNS resolver module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import logging
+import threading
+import time
+
+
+# SRV lookups shared by all the servers of a run; each name is only sent once however many threads ask for it, and
+# answers are kept until their TTL expires and expire() is called, names that do not exist only until then
+class Resolver(object):
+    def __init__(self):
+        self._log = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        # name mapped to the time its answers expire and the answers, SRV records as text
+        self._answers = {}
+        # names being resolved mapped to an event set once they are done
+        self._pending = {}
+
+    def srv(self, name, lifetime=None):
+        # SRV records of the name, empty if there are none; waits at most lifetime seconds if the name is being
+        # resolved by another thread
+        return self.lookup(name, lifetime)[0]
+
+    def lookup(self, name, lifetime=None):
+        # SRV records of the name, and whether this call sent the query rather than getting them from the answers
+        # kept or from another thread
+        key = name.lower()
+        while True:
+            with self._lock:
+                if key in self._answers:
+                    return self._answers[key][1], False
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    break
+            if not pending.wait(lifetime):
+                import dns.exception
+                raise dns.exception.Timeout()
+            # failures are not kept, if the other thread failed the name is resolved again
+
+        try:
+            answers = self._query(name, lifetime)
+        finally:
+            with self._lock:
+                self._pending.pop(key).set()
+        return answers, True
+
+    def _query(self, name, lifetime):
+        # dnspython is only imported once a name is not answered from the ones kept
+        import dns.resolver
+        self._log.debug('Resolving %s SRV' % name)
+        try:
+            answers = dns.resolver.query(name, 'SRV', lifetime=lifetime)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers):
+            self._log.debug('No %s SRV records' % name)
+            expires, records = time.time(), []
+        else:
+            expires, records = answers.expiration, [answer.to_text() for answer in answers]
+            self._log.debug('%s SRV: %s (expire in %d seconds)' % (name, ', '.join(records), expires - time.time()))
+        with self._lock:
+            self._answers[name.lower()] = expires, records
+        return records
+
+    def prefetch(self, names):
+        # resolves the names in the background, so that they are known by the time they are asked for
+        def resolve(name):
+            import dns.exception
+            try:
+                self.srv(name)
+            except dns.exception.DNSException as e:
+                self._log.debug('Failed to resolve %s (%s)' % (name, e))
+
+        for name in names:
+            if name.lower() in self._answers or name.lower() in self._pending:
+                continue
+            thread = threading.Thread(target=resolve, args=(name,))
+            thread.daemon = True
+            thread.start()
+
+    def expire(self):
+        # forgets the answers whose TTL has passed, called before each refresh of a long-running process
+        now = time.time()
+        with self._lock:
+            for name, (expires, records) in list(self._answers.items()):
+                if expires <= now:
+                    del self._answers[name]
+
+    def dump(self):
+        # answers still valid, for keeping them across runs
+        now = time.time()
+        with self._lock:
+            return dict((name, [expires, records]) for name, (expires, records) in self._answers.items()
+                        if expires > now)
+
+    def load(self, answers):
+        now = time.time()
+        with self._lock:
+            for name, (expires, records) in answers.items():
+                if expires > now:
+                    self._answers.setdefault(name, (expires, records))
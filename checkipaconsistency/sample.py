@@ -0,0 +1,89 @@
+#  -*- coding: utf-8 -*-
+"""
+Sampling module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import hashlib
+import heapq
+import math
+
+from .diff import STATE_ATTR, digest
+
+# attributes FreeIPA leaves out of its replication agreements, they may differ between servers
+LOCAL_ATTRS = frozenset(['memberof', 'idnssoaserial', 'entryusn', 'krblastsuccessfulauth', 'krblastfailedauth',
+                         'krbloginfailedcount'])
+
+# attributes read for every sampled entry
+SAMPLE_ATTRS = ['*', STATE_ATTR]
+
+# normal quantile of the 95% confidence level
+Z95 = 1.959964
+
+
+# reducer for FreeIPAServer.scan() keeping the size DNs with the lowest digests salted with the seed, a sample that
+# is uniform, the same for the same seed and directory, and takes no more memory however many entries are streamed
+class Sampler(object):
+    def __init__(self, size, seed=0):
+        self._size = size
+        self._salt = '%s:' % seed
+        self._heap = []
+        self.count = 0
+
+    def sample(self, entries):
+        for dn, attrs in entries:
+            self.count += 1
+            item = (-digest(self._salt + dn.lower()), dn)
+            if len(self._heap) < self._size:
+                heapq.heappush(self._heap, item)
+            elif item > self._heap[0]:
+                heapq.heapreplace(self._heap, item)
+        return self
+
+    @property
+    def dns(self):
+        return sorted(dn for key, dn in self._heap)
+
+
+def content_digest(attrs):
+    # digest of the replicated attributes of an entry, independent of the order of attributes and values
+    content = hashlib.sha256()
+    for attr in sorted(attr for attr in attrs if attr.lower() not in LOCAL_ATTRS):
+        content.update(attr.lower().encode('utf-8') + b'\0')
+        for value in sorted(attrs[attr]):
+            content.update(value + b'\0')
+    return content.hexdigest()
+
+
+def interval(divergent, sampled, population, z=Z95):
+    # Wilson score interval of the divergence rate, with the sample size scaled by the finite population correction
+    # so that a sample of the whole subtree gives the exact rate
+    if not sampled:
+        return 0.0, 1.0
+    rate = float(divergent) / sampled
+    if sampled >= population:
+        return rate, rate
+    n = sampled * (population - 1.0) / (population - sampled)
+    centre = (rate + z * z / (2 * n)) / (1 + z * z / n)
+    spread = z * math.sqrt(rate * (1 - rate) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, centre - spread), min(1.0, centre + spread)
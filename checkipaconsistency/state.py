@@ -0,0 +1,175 @@
+#  -*- coding: utf-8 -*-
+"""
+Incremental state module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import fcntl
+import logging
+import shelve
+import threading
+import time
+
+from .diff import EntryIndex, INDEX_ATTRS, KEY_ATTR, entry_key
+
+# entryUSN is local to every server but indexed by FreeIPA, and the USN plugin turns deleted entries into
+# tombstones with a new entryUSN, so deletes are picked up too; modifyTimestamp is used when USNs are not available
+USN_ATTR = 'entryUSN'
+TIMESTAMP_ATTR = 'modifyTimestamp'
+
+
+def _value(attrs, name):
+    for attr, values in attrs.items():
+        if attr.lower() == name.lower():
+            return values[0].decode('utf-8')
+    return None
+
+
+# per server and check records of the entry index and the high-water mark it was last synced to, kept in a shelf
+# that only one cipa process at a time may use
+class StateFile(object):
+    def __init__(self, path):
+        self._log = logging.getLogger(__name__)
+        self._path = path
+        self._mutex = threading.Lock()
+        self._lock = None
+        self._shelf = None
+
+    def open(self):
+        self._log.debug('Opening state file %s' % self._path)
+        self._lock = open(self._path + '.lock', 'a')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        self._shelf = shelve.open(self._path, protocol=2)
+        return self
+
+    def close(self):
+        self._log.debug('Closing state file %s' % self._path)
+        self._shelf.close()
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+
+    def get(self, server, check):
+        with self._mutex:
+            return self._shelf.get('%s/%s' % (server, check))
+
+    def set(self, server, check, record):
+        with self._mutex:
+            self._shelf['%s/%s' % (server, check)] = record
+
+
+# reducers applying streamed entries to an index while tracking the high-water mark
+class IndexSync(object):
+    def __init__(self, record=None):
+        record = record or {}
+        self.index = record.get('index') or EntryIndex()
+        self.usn = record.get('usn')
+        self.timestamp = record.get('timestamp')
+        self.full = record.get('full')
+
+    def _track(self, attrs):
+        usn = _value(attrs, USN_ATTR)
+        if usn is not None and (self.usn is None or int(usn) > self.usn):
+            self.usn = int(usn)
+        timestamp = _value(attrs, TIMESTAMP_ATTR)
+        if timestamp is not None and (self.timestamp is None or timestamp > self.timestamp):
+            self.timestamp = timestamp
+
+    def rebuild(self, entries):
+        self.index = EntryIndex()
+        for dn, attrs in entries:
+            self.index.append(dn, attrs)
+            self._track(attrs)
+        self.index.finish()
+        return self
+
+    def changes(self, entries):
+        for dn, attrs in entries:
+            self.index.update(dn, attrs)
+            self._track(attrs)
+        return self
+
+    def tombstones(self, entries):
+        # tombstones keep the nsUniqueId of the entry, their DN is the entry's last DN prefixed with it
+        for dn, attrs in entries:
+            self.index.remove(entry_key(dn.split(',', 1)[1], attrs))
+            self._track(attrs)
+        return self
+
+    @property
+    def mark(self):
+        # filter selecting the entries changed since the last sync, None if there is no usable mark
+        if self.usn is not None:
+            return '(%s>=%s)' % (USN_ATTR, self.usn + 1)
+        if self.timestamp is not None:
+            # entries changed within the same second are applied again, which is harmless
+            return '(%s>=%s)' % (TIMESTAMP_ATTR, self.timestamp)
+        return None
+
+    @property
+    def record(self):
+        return {'index': self.index, 'usn': self.usn, 'timestamp': self.timestamp, 'full': self.full, 'key': KEY_ATTR}
+
+
+def _usn_reset(server, check, state):
+    # a restore or a reinitialization starts the USNs over below the mark, which would then select none of the
+    # changes made since
+    if state.usn is None:
+        return False
+    last = server.last_usn(check)
+    return last is not None and last < state.usn
+
+
+def sync(server, check, record, resync):
+    # brings the check's entry index of the server up to date, returns the new record or False if the server could
+    # not be searched; a full scan is run when there is no record yet or the last one is older than resync seconds
+    log = logging.getLogger(__name__)
+    attrs = INDEX_ATTRS + [USN_ATTR]
+    if record and record.get('key') != KEY_ATTR:
+        # indexes kept by earlier versions are keyed by DN
+        record = None
+    state = IndexSync(record)
+    now = time.time()
+
+    if record and state.mark and now - state.full < resync and _usn_reset(server, check, state):
+        log.debug('%s: %s USNs were reset, rescanning' % (server.hostname_short, check))
+        record = None
+
+    if record and state.mark and now - state.full < resync:
+        log.debug('%s: syncing %s changes %s' % (server.hostname_short, check, state.mark))
+        # deletes go first, an entry deleted and added again since has a new nsUniqueId and is added back after
+        mark = state.mark
+        if server.scan_tombstones(check, state.tombstones, attrs, fltr=mark) is False:
+            return False
+        if server.scan(check, state.changes, attrs, fltr=mark) is False:
+            return False
+        # numSubordinates is a cheap guard against changes the high-water mark missed; the entries counted one by
+        # one have no such count, their indexes only rely on the mark, the USN reset guard above and the full scan
+        # every resync seconds, so with a modifyTimestamp mark a missed change is only picked up by that scan
+        if server.counts_entries(check) or len(state.index) == getattr(server, check):
+            return state.record
+        log.debug('%s: %s index out of sync, rescanning' % (server.hostname_short, check))
+
+    log.debug('%s: full scan of %s' % (server.hostname_short, check))
+    if server.scan(check, state.rebuild, attrs) is False:
+        return False
+    state.full = now
+    return state.record
@@ -0,0 +1,165 @@
+#  -*- coding: utf-8 -*-
+"""
+Content synchronization module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+import logging
+import threading
+
+import ldap
+from ldap.ldapobject import SimpleLDAPObject
+from ldap.syncrepl import SyncreplConsumer
+
+from .checks import NO_ATTRS
+
+# seconds a check waits for the first refresh of its session when there is no deadline, it searches the server
+# itself after that
+REFRESH_WAIT = 60
+
+
+# connection of a session, forwarding the callbacks of python-ldap's consumer to it
+class _Consumer(SimpleLDAPObject, SyncreplConsumer):
+    def __init__(self, url, session):
+        SimpleLDAPObject.__init__(self, url)
+        self._session = session
+
+    def syncrepl_get_cookie(self):
+        return self._session.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self._session.cookie = cookie
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        self._session.entry(dn, uuid)
+
+    def syncrepl_delete(self, uuids):
+        self._session.delete(uuids)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        self._session.present(uuids, refreshDeletes)
+
+    def syncrepl_refreshdone(self):
+        self._session.refreshed()
+
+
+# RFC 4533 content synchronization session (refreshAndPersist) keeping the set of entries a search selects, by
+# entryUUID, up to date from the server's change notifications; it runs in a thread on a connection of its own, and
+# a session that ended is started afresh with a full refresh rather than merged with the entries it kept
+class SyncSession(object):
+    def __init__(self, url, binddn, bindpw, base, fltr, scope, name):
+        self._log = logging.getLogger(__name__)
+        self._url = url
+        self._binddn = binddn
+        self._bindpw = bindpw
+        self._search = base, fltr, scope
+        self._name = name
+        self.cookie = None
+        # entryUUID mapped to DN, and the entries reported present during a refresh
+        self._entries = {}
+        self._present = set()
+        self._lock = threading.Lock()
+        # set once the first refresh is done or the session has ended
+        self._ready = threading.Event()
+        self._refreshed = False
+        self._alive = False
+
+    def start(self):
+        with self._lock:
+            if self._alive:
+                return
+            self._alive = True
+            self._refreshed = False
+            self._ready.clear()
+            # the entries of a session that ended are not merged with a new refresh, which lists them all again
+            self.cookie = None
+            self._entries = {}
+            self._present = set()
+        self._log.debug('%s: starting content synchronization' % self._name)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        conn = None
+        base, fltr, scope = self._search
+        try:
+            conn = _Consumer(self._url, self)
+            conn.set_option(ldap.OPT_NETWORK_TIMEOUT, 3)
+            conn.set_option(ldap.OPT_REFERRALS, ldap.OPT_OFF)
+            conn.simple_bind_s(self._binddn, self._bindpw)
+            msgid = conn.syncrepl_search(base, scope, mode='refreshAndPersist', filterstr=fltr, attrlist=NO_ATTRS)
+            # only returns once the server ends the search
+            conn.syncrepl_poll(msgid=msgid, all=1)
+            self._log.debug('%s: content synchronization ended by the server' % self._name)
+        except ldap.LDAPError as e:
+            self._log.debug('%s: content synchronization failed (%s)' % (self._name, e))
+        finally:
+            with self._lock:
+                self._alive = False
+                self._refreshed = False
+            self._ready.set()
+            if conn is not None:
+                try:
+                    conn.unbind_s()
+                except ldap.LDAPError:
+                    pass
+
+    def entry(self, dn, uuid):
+        with self._lock:
+            self._entries[uuid] = dn
+            if not self._refreshed:
+                # entries sent in full during a present phase are present too
+                self._present.add(uuid)
+
+    def delete(self, uuids):
+        with self._lock:
+            for uuid in uuids:
+                self._entries.pop(uuid, None)
+
+    def present(self, uuids, deletes):
+        with self._lock:
+            if uuids is None:
+                if not deletes:
+                    # end of a present phase, the entries not reported present are gone
+                    for uuid in set(self._entries) - self._present:
+                        del self._entries[uuid]
+                self._present = set()
+            elif deletes:
+                for uuid in uuids:
+                    self._entries.pop(uuid, None)
+            else:
+                self._present.update(uuids)
+
+    def refreshed(self):
+        with self._lock:
+            self._refreshed = True
+            count = len(self._entries)
+        self._log.debug('%s: refreshed, %s entries' % (self._name, count))
+        self._ready.set()
+
+    def count(self, timeout=None):
+        # number of entries once the session is refreshed and following the changes, None if it is not
+        self._ready.wait(REFRESH_WAIT if timeout is None else timeout)
+        with self._lock:
+            return len(self._entries) if self._refreshed and self._alive else None
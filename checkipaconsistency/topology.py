@@ -0,0 +1,164 @@
+#  -*- coding: utf-8 -*-
+"""
+Replication topology module
+
+Author: Peter Pakos <peter.pakos@wandisco.com>
+
+Copyright (C) 2017 WANdisco
+
+This file is part of checkipaconsistency.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import print_function
+from collections import OrderedDict
+
+from .checks import HEALTHY_STATUSES
+
+# ends of a segment replicating in each of its directions
+DIRECTIONS = {
+    'both': ((0, 1), (1, 0)),
+    'left-right': ((0, 1),),
+    'right-left': ((1, 0),),
+}
+
+
+# replication graph of a domain: the segments FreeIPA manages in cn=topology, each an agreement from a supplier to a
+# consumer in one or both directions, checked against the agreements the servers report; every pass is linear in the
+# number of replicas and agreements
+class Topology(object):
+    def __init__(self, segments):
+        # replicas mapped to the consumers they replicate to, as the topology defines them
+        self.expected = OrderedDict()
+        for left, right, direction in segments:
+            ends = left.lower(), right.lower()
+            for supplier, consumer in DIRECTIONS.get((direction or 'both').lower(), DIRECTIONS['both']):
+                self._node(ends[consumer])
+                self._node(ends[supplier]).add(ends[consumer])
+        self.segments = len(segments)
+        # suppliers mapped to their agreements' consumers and statuses, None when the server could not be read
+        self.reported = {}
+        self.unreachable = []
+
+    def _node(self, name):
+        return self.expected.setdefault(name, set())
+
+    def add(self, supplier, agreements, reachable=True):
+        # agreements are (consumer, status) pairs as the supplier reports them, None if it did not report any
+        supplier = supplier.lower()
+        self._node(supplier)
+        if not reachable:
+            self.unreachable.append(supplier)
+        self.reported[supplier] = None if agreements is None else \
+            dict((consumer.lower(), status) for consumer, status in agreements)
+
+    def _healthy(self):
+        # suppliers mapped to the consumers their changes get through to; the agreements of replicas that were not
+        # checked are assumed to work
+        healthy = {}
+        for supplier, consumers in self.expected.items():
+            if supplier in self.unreachable:
+                continue
+            agreements = self.reported.get(supplier)
+            if agreements is None:
+                healthy[supplier] = [c for c in consumers if c not in self.unreachable]
+            else:
+                healthy[supplier] = [c for c, status in agreements.items()
+                                     if status in HEALTHY_STATUSES and c in self.expected and c not in self.unreachable]
+        return healthy
+
+    def broken(self):
+        # agreements of the topology failing on a supplier that answered, or missing from it
+        broken = []
+        for supplier, consumers in self.expected.items():
+            agreements = self.reported.get(supplier)
+            if agreements is None:
+                continue
+            for consumer in sorted(consumers):
+                status = agreements.get(consumer, 'missing')
+                if status not in HEALTHY_STATUSES:
+                    broken.append([supplier, consumer, status])
+        return sorted(broken)
+
+    def unmanaged(self):
+        # agreements the servers report that no segment defines, such as winsync agreements with AD; listed but not
+        # a problem
+        return [[supplier, consumer] for supplier, agreements in sorted(self.reported.items()) if agreements
+                for consumer in sorted(agreements) if consumer not in self.expected.get(supplier, ())]
+
+    def partitions(self):
+        # strongly connected components of the working agreements (Tarjan's algorithm, iterative so that long chains
+        # do not hit the recursion limit): groups of replicas whose changes all reach one another, one when the
+        # topology is healthy; unreachable replicas are left out as they are reported on their own
+        edges = self._healthy()
+        index, low, stack, on_stack, components = {}, {}, [], set(), []
+        for root in edges:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(edges[root]))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(edges.get(child, ()))))
+                        break
+                    if child in on_stack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(sorted(component))
+        return sorted(components)
+
+    def report(self):
+        return {
+            'replicas': len(self.expected),
+            'segments': self.segments,
+            'broken': self.broken(),
+            'unreachable': sorted(self.unreachable),
+            'unmanaged': self.unmanaged(),
+            'partitions': self.partitions(),
+        }
+
+
+def problems(report, short=lambda name: name):
+    # what is wrong with the topology in a few words, empty if nothing is
+    found = []
+    if report['broken']:
+        found.append('broken %s' % ', '.join('%s->%s (%s)' % (short(supplier), short(consumer), status)
+                                             for supplier, consumer, status in report['broken']))
+    if report['unreachable']:
+        found.append('unreachable %s' % ', '.join(short(name) for name in report['unreachable']))
+    if len(report['partitions']) > 1:
+        found.append('partitioned %s' % ' | '.join(' '.join(short(name) for name in partition)
+                                                   for partition in report['partitions']))
+    return found